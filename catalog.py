@@ -0,0 +1,160 @@
+import os
+import re
+import sqlite3
+import datetime
+import time
+
+'''
+SQLite catalog of the source data files under ./data.
+
+Every dataset folder is walked once, file names are parsed into keys (variable, year/month/date, MODIS product and
+tile, ASTER lat/lon) and stored with the file size and mtime, so queries such as "TEM files of 1999" or "MOD13Q1
+tiles of a date" are indexed lookups instead of a walk of the whole tree and a parse of every name.
+
+Refreshing a folder only re-parses new or modified files and drops deleted ones.
+
+> with DataCatalog() as catalog:
+>     files = catalog.files('surf', './data/SURF_CLI_CHN_MUL_DAY/DATA', var='TEM', year=1999)
+
+├── data
+|   ├── catalog.sqlite (generated)
+
+'''
+
+catalog_file = './data/catalog.sqlite'
+
+columns = ['name', 'ext', 'var', 'product', 'tile', 'date', 'year', 'month', 'lat', 'lon']
+
+
+def parse_surf_name(name: str):
+    ''' SURF_CLI_CHN_MUL_DAY-TEM-12001-199901.TXT -> monthly file of a variable '''
+    match = re.match(r'SURF_CLI_CHN_MUL_DAY-([A-Za-z]+)-\d+-(\d{4})(\d{2})\.TXT$', name, re.IGNORECASE)
+    if match is None:
+        return None
+    year, month = int(match.group(2)), int(match.group(3))
+    return {'var': match.group(1).upper(), 'year': year, 'month': month, 'date': datetime.date(year, month, 1)}
+
+
+def parse_aster_name(name: str):
+    ''' ASTGTMV003_N34E111_dem.tif -> lat and lon of the tile (the _num.tif quality layers are skipped) '''
+    match = re.search(r'N(\d+)E(\d+)_dem\.tif$', name)
+    if match is None:
+        return None
+    return {'lat': int(match.group(1)), 'lon': int(match.group(2))}
+
+
+def parse_modis_name(name: str):
+    ''' MCD15A3H.A2018017.h25v06.006.2018023210623.hdf (or a tif of one of its layers, ..._08.tif) '''
+    match = re.match(r'(\w+)\.A(\d{4})(\d{3})\.(h\d+v\d+)\.', name)
+    if match is None:
+        return None
+    date = datetime.date(int(match.group(2)), 1, 1) + datetime.timedelta(int(match.group(3)) - 1)
+    feature = re.findall(r'_(\d+)', name)
+    return {'product': match.group(1), 'date': date, 'year': date.year, 'tile': match.group(4),
+            'var': feature[-1] if name.endswith('.tif') and len(feature) > 0 else None}
+
+
+def parse_soil_name(name: str):
+    ''' soil source layers, e.g. POR.nc, POR.tif, or binary layers without extension '''
+    return {'var': name.split('.')[0]}
+
+
+parsers = {'surf': parse_surf_name, 'aster': parse_aster_name, 'modis': parse_modis_name, 'soil': parse_soil_name}
+
+
+class DataCatalog():
+    '''
+    Catalog of the files of the datasets in parsers, kept in SQLite at db_file.
+    '''
+
+    def __init__(self, db_file=catalog_file):
+        folder = os.path.dirname(os.path.abspath(db_file))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        # several processes may share the catalog, wait for a writer instead of failing
+        self.db = sqlite3.connect(db_file, timeout=60)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY, dataset TEXT, root TEXT, size INTEGER, mtime REAL, name TEXT, ext TEXT,
+                var TEXT, product TEXT, tile TEXT, date TEXT, year INTEGER, month INTEGER, lat INTEGER, lon INTEGER);
+            CREATE INDEX IF NOT EXISTS files_root ON files (dataset, root);
+            CREATE INDEX IF NOT EXISTS files_var ON files (dataset, var, year, month);
+            CREATE INDEX IF NOT EXISTS files_product ON files (dataset, product, date, tile);
+            CREATE INDEX IF NOT EXISTS files_tile ON files (dataset, lat, lon);
+            CREATE TABLE IF NOT EXISTS roots (dataset TEXT, root TEXT, scanned REAL, PRIMARY KEY (dataset, root));
+        ''')
+
+    def scanned(self, dataset: str, root: str):
+        ''' :return: time of the last scan of root, None if never scanned '''
+        row = self.db.execute('SELECT scanned FROM roots WHERE dataset = ? AND root = ?',
+                              (dataset, os.path.abspath(root))).fetchone()
+        return row[0] if row is not None else None
+
+    def index(self, dataset: str, root: str, refresh=False):
+        '''
+        Add the files under root to the catalog. Only new or modified files (by size and mtime) are parsed, and
+        files no longer on disk are removed.
+
+        :param dataset: key of parsers
+        :param refresh: rescan root even if it was scanned before (e.g. after adding files)
+        '''
+        root = os.path.abspath(root)
+        if not refresh and self.scanned(dataset, root) is not None:
+            return
+        parse = parsers[dataset]
+        known = {path: (size, mtime) for path, size, mtime in self.db.execute(
+            'SELECT path, size, mtime FROM files WHERE dataset = ? AND root = ?', (dataset, root))}
+        rows = []
+        seen = set()
+        for folder, _, filenames in os.walk(root):
+            for name in filenames:
+                path = os.path.join(folder, name)
+                stat = os.stat(path)
+                seen.add(path)
+                if known.get(path) == (stat.st_size, stat.st_mtime):
+                    continue
+                keys = parse(name)
+                if keys is None:
+                    continue
+                keys.update({'name': name, 'ext': os.path.splitext(name)[1][1:].lower()})
+                if keys.get('date') is not None:
+                    keys['date'] = keys['date'].isoformat()
+                rows.append([path, dataset, root, stat.st_size, stat.st_mtime] + [keys.get(c) for c in columns])
+        with self.db:
+            self.db.executemany(f'INSERT OR REPLACE INTO files VALUES ({", ".join(["?"] * (5 + len(columns)))})',
+                                rows)
+            self.db.executemany('DELETE FROM files WHERE path = ?', [(path,) for path in set(known) - seen])
+            self.db.execute('INSERT OR REPLACE INTO roots VALUES (?, ?, ?)', (dataset, root, time.time()))
+
+    def records(self, dataset: str, root: str, refresh=False, **keys) -> list:
+        '''
+        :param keys: filters on columns, e.g. var='TEM', year=1999; a list, tuple or set matches any of its items
+        :return: [{'path': path, 'size': size, 'mtime': mtime, column: value}] of the matching files, in date and
+                 path order
+        '''
+        self.index(dataset, root, refresh=refresh)
+        where = ['dataset = ?', 'root = ?']
+        params = [dataset, os.path.abspath(root)]
+        for key, value in keys.items():
+            if key not in columns:
+                raise KeyError(f'unknown catalog column {key}')
+            values = list(value) if isinstance(value, (list, tuple, set)) else [value]
+            values = [v.isoformat()[:10] if isinstance(v, (datetime.date, datetime.datetime)) else v for v in values]
+            where.append(f'{key} IN ({", ".join(["?"] * len(values))})')
+            params += values
+        cursor = self.db.execute(f'SELECT path, size, mtime, {", ".join(columns)} FROM files '
+                                 f'WHERE {" AND ".join(where)} ORDER BY date, path', params)
+        return [dict(zip(['path', 'size', 'mtime'] + columns, row)) for row in cursor]
+
+    def files(self, dataset: str, root: str, refresh=False, **keys) -> list:
+        ''' :return: paths of the matching files, see records '''
+        return [record['path'] for record in self.records(dataset, root, refresh=refresh, **keys)]
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
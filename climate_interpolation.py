@@ -9,6 +9,7 @@ import scipy
 from osgeo import gdal, osr
 
 from utils import *
+from catalog import DataCatalog, catalog_file
 
 '''
 Interpolate situ meteorological data to raster time series, based on SURF_CLI_CHN_MUL_DAY. 
@@ -95,7 +96,7 @@ def remove_date_zeros(date):
 
 
 def geotif_from_array(array: np.array, lat_start: float, lat_end: float, lon_start: float, lon_end: float,
-                      degree: float, output_file: str):
+                      degree: float, output_file: str, dtype='float32', scale=None, overviews=None):
     """
     Write a numpy.array to a GeoTIFF file with location information, using the WGS84 (EPSG: 4326) coordinate system by default
     array: data to be written to GeoTIFF
@@ -105,28 +106,18 @@ def geotif_from_array(array: np.array, lat_start: float, lat_end: float, lon_sta
     lon_end: maximum longitude
     degree: output raster unit size (unit: degree)
     output_file: output GeoTIFF file path
+    dtype: 'float32' (default), None to keep the dtype of array, or 'int16' scaled by scale (see utils.write_geotif)
+    overviews: factors of internal overviews to build, None for no overviews
     """
-    mag_grid = np.float64(array)
-    num_v = mag_grid.shape[0]
-    num_h = mag_grid.shape[1]
+    num_v = array.shape[0]
+    num_h = array.shape[1]
     print(num_h, num_v)
     lats = np.linspace(lat_start, lat_end, num_v)
     lons = np.linspace(lon_start, lon_end, num_h)
-    assert len(lats) == mag_grid.shape[0]
-    assert len(lons) == mag_grid.shape[1]
-    ysize = len(lats)
-    xsize = len(lons)
-    driver = gdal.GetDriverByName('GTiff')
-    ds = driver.Create(output_file, xsize, ysize, 1, gdal.GDT_Float32)
-    srs = osr.SpatialReference()
-    srs.ImportFromEPSG(4326)
-    ds.SetProjection(srs.ExportToWkt())
+    assert len(lats) == array.shape[0]
+    assert len(lons) == array.shape[1]
     gt = [lon_start, degree, 0, lat_start + degree * num_h, 0, -degree]
-    ds.SetGeoTransform(gt)
-    outband = ds.GetRasterBand(1)
-    outband.SetStatistics(np.min(mag_grid), np.max(mag_grid), np.average(mag_grid), np.std(mag_grid))
-    outband.WriteArray(mag_grid)
-    ds = None
+    write_geotif(array, gt, output_file, dtype=dtype, scale=scale, overviews=overviews)
 
 
 def idw_interpolation(x: np.array, y: np.array, z: np.array, lat_start: float, lat_end: float, lon_start: float,
@@ -171,23 +162,13 @@ def qualified_files(date_range: pd.date_range, variable: str, cfg):
                '平均气温': 'tem', '日最高气温': 'tem', '日最低气温': 'tem', '平均风速': 'win', '最大风速': 'win'}
     variable = var_all[variable].upper()
 
-    date_range = set([datetime2str(x, sep='-') for x in date_range])
-    files = absolute_file_paths(cfg['data_root'])
-    var_files = []
-    found = False
-    for file in files:
-        if variable in file:
-            txt_date_range = set(get_date_range_from_txt(file))
-            if not date_range.isdisjoint(txt_date_range):
-                found = True
-                var_files.append(file)
-    if not found:
+    # one monthly file per variable, looked up in the catalog by variable and month
+    months = sorted(set(datetime.date(x.year, x.month, 1) for x in date_range))
+    with DataCatalog(cfg.get('catalog_file', catalog_file)) as catalog:
+        var_files = catalog.files('surf', cfg['data_root'], var=variable, date=months)
+    if len(var_files) == 0:
         raise ValueError("Did not find file needed.")
-
-    def custum_key(file):
-        return int(file[-10:-4])
-
-    return sorted(var_files, key=custum_key)
+    return var_files
 
 
 def evp_convert(data):
@@ -378,7 +359,8 @@ def variable_tif(date_start, date_end, variable, cfg):
                 os.mkdir(f'{cfg["outdir"]}/{variable}')
             geotif_from_array(array=tmp_res, lat_start=cfg['lat_start'], lat_end=cfg['lat_end'],
                               lon_start=cfg['lon_start'], lon_end=cfg['lon_end'], degree=cfg['degree'],
-                              output_file=f'{cfg["outdir"]}/{variable}/{key + "-" + variable}.tif')
+                              output_file=f'{cfg["outdir"]}/{variable}/{key + "-" + variable}.tif',
+                              dtype='float32')
 
 
 def mutil(cfg):
@@ -389,6 +371,9 @@ def mutil(cfg):
     :return: None
     '''
     proc = []
+    # index the station files once, before the processes query the catalog
+    with DataCatalog(cfg.get('catalog_file', catalog_file)) as catalog:
+        catalog.index('surf', cfg['data_root'], refresh=True)
 
     for variable in ['大型蒸发量', '日最高地表气温', '日最低地表气温', '平均地表气温',
                      '20-20时累计降水量', '平均本站气压', '日最高本站气压',
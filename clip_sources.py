@@ -0,0 +1,54 @@
+from tqdm import tqdm
+
+from utils import *
+from catalog import DataCatalog, catalog_file
+from land_cover import annual_igbp_tifs
+
+'''
+Clip the global source rasters to the region of the basins.
+
+GLiM, IGBP, GLHYMPS and the soil layers are global, while a run only needs the area of its basins. This script
+computes the union bbox of the shapefiles (plus a margin) and writes a tiled, compressed copy of every source
+raster clipped to it under ./data/clipped (see clip_raster). The attribute scripts then read the clip instead of the
+global file whenever it is up to date and covers their basins (see clipped_raster); otherwise they fall back to the
+source, so running this script is optional.
+
+The binary soil layers of Dai et al. are clipped once soil.py has converted them to tif. Rerun after adding basins
+outside the clipped region or updating a source raster.
+
+The directory should be structured as follows:
+├── clip_sources.py
+├── shapefiles
+|   ├── basin_0000.shp
+|   ├── basin_0001.shp
+├── data
+|   ├── clipped (generated)
+
+'''
+
+# degrees added around the union bbox of the basins
+margin = 0.5
+
+
+def source_rasters() -> list:
+    ''' :return: the source rasters of the attribute scripts that exist on disk '''
+    tifs = ['./data/processed_glim.tif',
+            './data/processed_igbp.tif',
+            './data/processed_permeability.tif',
+            './data/processed_porosity.tif']
+    tifs += list(annual_igbp_tifs().values())
+    if os.path.isdir('./data/soil_source_data'):
+        with DataCatalog(catalog_file) as catalog:
+            tifs += catalog.files('soil', './data/soil_source_data', refresh=True, ext='tif')
+    return [tif for tif in tifs if os.path.isfile(tif)]
+
+
+if __name__ == '__main__':
+    print('-> clip source rasters')
+    shps = [file for file in absolute_file_paths('./shapefiles') if file.endswith('.shp')]
+    left, bottom, right, top = shapefiles_bounds(shps)
+    bounds = (left - margin, bottom - margin, right + margin, top + margin)
+    for tif in tqdm(source_rasters()):
+        if clipped_raster(tif, bounds=bounds) != tif:
+            continue
+        clip_raster(tif, clipped_path(tif), bounds)
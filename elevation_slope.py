@@ -1,16 +1,20 @@
-import re
 import math
+from multiprocessing import Pool
 
 import shapefile
 import richdem as rd
-from osgeo import gdal, osr
+from rasterio.vrt import WarpedVRT
+from rasterio.transform import Affine
+from osgeo import gdal
 import pandas as pd
 from tqdm import tqdm
 
 from utils import *
+from catalog import DataCatalog, catalog_file
 
 '''
-Calculate catchment-scale elevation and slope based on the ASTER GDEM.
+Calculate catchment-scale elevation and slope based on the ASTER GDEM: mean, 5/50/95 percentiles of elevation and slope 
+and the hypsometric integral, as well as mean aspect, topographic wetness index and drainage density.
 
 Reference: https://asterweb.jpl.nasa.gov/gdem.asp
 
@@ -28,22 +32,26 @@ The directory should be structured as follows:
 |   |   ├── ASTGTMV003_N32E110_dem.tif
 |   |   ├── ASTGTMV003_N33E109_dem.tif
 |   |   ├── ASTGTMV003_N34E108_dem.tif
+|   ├── catalog.sqlite (generated, see catalog.py)
+|   ├── dems.vrt (generated)
+|   ├── slope (generated, see build_slope_raster)
+|   ├── slope.vrt (generated)
 ├── output
 
 '''
 
-
-def load_N_E_from_dem_name(dem_file: str):
-    ''' return lat and lon from aster dem file names '''
-    N = re.findall('N(\d+)', dem_file)[0]
-    E = re.findall('E(\d+)', dem_file)[0]
-    return {'N': int(N), 'E': int(E)}
+km_per_degree = 111.195  # length of one degree of latitude, mean earth radius
+elev_bins = (-500, 9000, 1)  # lower, upper, bin width (m) of the elevation histograms
+slope_bins = (0, 5000, 1)  # lower, upper, bin width (m/km) of the slope histograms
+max_terrain_pixels = 4096 * 4096  # larger basins are block averaged before flow routing, bounds memory
+channel_area_km2 = 1.  # minimum upstream area of a channel cell, for drainage density
 
 
 def shapefile_N_E(shpfile: str):
     ''' return min/max lat/lon, this is for determining the range of needed dem files '''
     sf = shapefile.Reader(shpfile)
     bbox = sf.bbox
+    sf.close()
     return {'N_min': bbox[1], 'N_max': bbox[3], 'E_min': bbox[0], 'E_max': bbox[2]}
 
 
@@ -55,119 +63,417 @@ def fetch_shapefile_needed_DEM_range(shpfile: str):
     return {'Ns': Ns, 'Es': Es}
 
 
-def elev_mean(shpfile: str, dem_folder: str):
-    ''' calculate mean elevation of the catchment '''
-    # if os.path.isfile(tmp_merged):
-    #     os.remove(tmp_merged)
-    # if os.path.isfile(tmp_reprojected):
-    #     os.remove(tmp_reprojected)
-
-    # get needed N E range
-    needed_Ns = fetch_shapefile_needed_DEM_range(shpfile)['Ns']
-    needed_Es = fetch_shapefile_needed_DEM_range(shpfile)['Es']
-
-    print(f"-> {os.path.basename(shpfile)}: lat range: {needed_Ns}, lon range: {needed_Es}")
-
-    # get needed tifs
-    files = absolute_file_paths(dem_folder)
-    files = [file for file in files if file.endswith('.tif')]
-    needed_tifs = []
-    for file in files:
-        N = load_N_E_from_dem_name(file)['N']
-        E = load_N_E_from_dem_name(file)['E']
-        if (N in needed_Ns) and (E in needed_Es):
-            needed_tifs.append(file)
-    if len(needed_tifs) < len(needed_Ns) * len(needed_Es):
-        import warnings
-        warnings.warn(f"DEMs may not cover the watershed completely")
-
-    # merge tifs
-    if len(needed_tifs) == 0:
-        raise FileNotFoundError(f'did not find needed tifs for determining topograpy attributes | shpfile: {shpfile}')
-    merge_tifs(needed_tifs, tmp_merged)
-    reproject_tif(tmp_merged, tmp_reprojected)
-    # zonal stats
-    try:
-        res = zonal_stats_singletif(tmp_reprojected, shpfile)
-    except ValueError as e:
-        print(e)
-        print('->', needed_Es, needed_Ns, needed_tifs)
-        return np.nan
+def build_dem_tile_index(dem_folder: str, catalog_file: str = catalog_file, refresh=False):
+    '''
+    (lat, lon) -> path index of the ASTER GDEM tiles, from the data catalog
+
+    :param dem_folder: folder of the ASTER GDEM tifs
+    :param catalog_file: sqlite data catalog, see catalog.py
+    :param refresh: rescan dem_folder even if it is already in the catalog (e.g. after adding tiles)
+    :return: {(N, E): tif path}
+    '''
+    tile_index = {}
+    with DataCatalog(catalog_file) as catalog:
+        records = catalog.records('aster', dem_folder, refresh=refresh)
+    for record in records:
+        # catalogs scanned before _num.tif was skipped may still list the quality layers
+        if not record['path'].endswith('_dem.tif'):
+            continue
+        key = (record['lat'], record['lon'])
+        if key in tile_index:
+            import warnings
+            warnings.warn(f"duplicate DEM tiles for N{key[0]}E{key[1]}: {tile_index[key]}, {record['path']}")
+            continue
+        tile_index[key] = record['path']
+    return tile_index
+
+
+class DemMosaic():
+    '''
+    Virtual mosaic (GDAL VRT) over all indexed ASTER GDEM tiles.
+
+    Basins are read through windows of the VRT, so only the pixels inside the basin bbox are read and no merged
+    tif is written. The VRT is only warped (on the fly, window by window) if it is not already in out_crs.
+
+    :param refresh: rescan dem_folder for added, modified or removed tiles; the VRT is rebuilt only if the tiles
+                    changed
+    '''
+
+    def __init__(self, dem_folder: str, catalog_file: str, vrt_file: str, refresh=False, out_crs='EPSG:4326'):
+        self.tile_index = build_dem_tile_index(dem_folder, catalog_file, refresh=refresh)
+        if len(self.tile_index) == 0:
+            raise FileNotFoundError(f'did not find any dem tif in {dem_folder}')
+        if self.vrt_outdated(vrt_file):
+            vrt = gdal.BuildVRT(vrt_file, sorted(self.tile_index.values()))
+            vrt = None
+        self.vrt = rasterio.open(vrt_file)
+        self.nodata = self.vrt.nodata if self.vrt.nodata is not None else -9999
+        if self.vrt.crs == CRS.from_user_input(out_crs):
+            self.src = self.vrt
+        else:
+            self.src = WarpedVRT(self.vrt, crs=out_crs, nodata=self.nodata)
+
+    def vrt_outdated(self, vrt_file: str):
+        ''' :return: True if vrt_file is missing, does not list exactly the indexed tiles or is older than one '''
+        if not os.path.isfile(vrt_file):
+            return True
+        tiles = set(os.path.abspath(tif) for tif in self.tile_index.values())
+        with rasterio.open(vrt_file) as vrt:
+            files = set(os.path.abspath(file) for file in vrt.files) - {os.path.abspath(vrt_file)}
+        return files != tiles or max(os.path.getmtime(tif) for tif in tiles) > os.path.getmtime(vrt_file)
+
+    def needed_tifs(self, shpfile: str):
+        ''' return the indexed tifs covering the given shapefile '''
+        needed_range = fetch_shapefile_needed_DEM_range(shpfile)
+        needed_keys = [(N, E) for N in needed_range['Ns'] for E in needed_range['Es']]
+        needed_tifs = [self.tile_index[key] for key in needed_keys if key in self.tile_index]
+        if len(needed_tifs) < len(needed_keys):
+            import warnings
+            warnings.warn(f"DEMs may not cover the watershed completely")
+        if len(needed_tifs) == 0:
+            raise FileNotFoundError(f'did not find needed tifs for determining topograpy attributes | shpfile: {shpfile}')
+        return needed_tifs
+
+    def read(self, bounds: tuple, halo=0):
+        ''' see read_bounds '''
+        return read_bounds(self.src, bounds, halo=halo, fill_value=self.nodata)
+
+    def close(self):
+        self.src.close()
+        self.vrt.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def shapefile_bounds(shpfile: str):
+    N_E = shapefile_N_E(shpfile)
+    return N_E['E_min'], N_E['N_min'], N_E['E_max'], N_E['N_max']
+
+
+def basin_shapes(shpfile: str):
+    with fiona.open(shpfile, "r") as shp:
+        return [feature["geometry"] for feature in shp]
+
+
+def iter_basin_blocks(src, shapes: list, bounds: tuple, block_rows=1024, block_cols=1024, halo=0, nodata=None):
+    '''
+    Walk the basin bbox of src in blocks of block_rows x block_cols pixels, so memory does not grow with the basin
+    size in either direction.
+
+    :param halo: number of extra pixels read around each block (e.g. 1 for slope)
+    :return: generator of {'array': block with halo, nan for nodata, 'transform': transform of array,
+                           'mask': basin mask of the block without the halo,
+                           'row', 'col': offset of the block in the basin window}
+    '''
+    window = bounds_window(src, bounds)
+    for row in range(0, window.height, block_rows):
+        height = min(block_rows, window.height - row)
+        for col in range(0, window.width, block_cols):
+            width = min(block_cols, window.width - col)
+            block = rasterio.windows.Window(window.col_off + col - halo, window.row_off + row - halo,
+                                            width + 2 * halo, height + 2 * halo)
+            array = read_window(src, block, fill_value=nodata).astype(np.float64)
+            if nodata is not None:
+                array[array == nodata] = np.nan
+            transform = src.window_transform(block)
+            interior = rasterio.windows.Window(halo, halo, width, height)
+            mask = rasterio.features.geometry_mask(shapes, out_shape=(height, width),
+                                                   transform=rasterio.windows.transform(interior, transform),
+                                                   invert=True)
+            yield {'array': array, 'transform': transform, 'mask': mask, 'row': row, 'col': col}
+
+
+class StreamingHistogram():
+    '''
+    Fixed-bin histogram filled block by block. Memory does not depend on the number of pixels; the mean, min and max
+    are kept exactly, percentiles are interpolated within the bins.
+    '''
+
+    def __init__(self, lower: float, upper: float, bin_width: float):
+        self.lower = lower
+        self.bin_width = bin_width
+        self.counts = np.zeros(int(math.ceil((upper - lower) / bin_width)), dtype=np.int64)
+        self.sum = 0.
+        self.min = np.inf
+        self.max = -np.inf
+
+    def update(self, values: np.array):
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return
+        index = np.clip(((values - self.lower) / self.bin_width).astype(np.int64), 0, len(self.counts) - 1)
+        self.counts += np.bincount(index, minlength=len(self.counts))
+        self.sum += np.sum(values)
+        self.min = min(self.min, np.min(values))
+        self.max = max(self.max, np.max(values))
+
+    @property
+    def count(self):
+        return np.sum(self.counts)
+
+    def mean(self):
+        return self.sum / self.count if self.count > 0 else np.nan
+
+    def percentile(self, q: float):
+        ''' :param q: percentile in [0, 100] '''
+        if self.count == 0:
+            return np.nan
+        target = q / 100 * self.count
+        if target <= 0:
+            return self.min
+        cumulative = np.cumsum(self.counts)
+        i = np.searchsorted(cumulative, target)
+        previous = cumulative[i - 1] if i > 0 else 0
+        value = self.lower + (i + (target - previous) / self.counts[i]) * self.bin_width
+        return min(max(value, self.min), self.max)
+
+    def hypsometric_integral(self):
+        ''' (mean - min) / (max - min), i.e. the area under the hypsometric curve '''
+        if self.count == 0 or self.max == self.min:
+            return np.nan
+        return (self.mean() - self.min) / (self.max - self.min)
+
+
+def horn_gradient(dem: np.array, transform):
+    '''
+    Gradient of a DEM in geographic coordinates (Horn's method), rise in m / run in km. The run is computed for each
+    row from its latitude instead of a constant 111 km per degree.
+
+    :param dem: DEM with a one-pixel halo, nan for nodata
+    :param transform: transform of dem
+    :return: (dz/dx towards east, dz/dy towards south) of the interior, i.e. dem.shape - 2
+    '''
+    rows = np.arange(1, dem.shape[0] - 1)
+    lats = transform.f + (rows + 0.5) * transform.e
+    dx = abs(transform.a) * km_per_degree * np.cos(np.deg2rad(lats))[:, np.newaxis]
+    dy = abs(transform.e) * km_per_degree
+    a, b, c = dem[:-2, :-2], dem[:-2, 1:-1], dem[:-2, 2:]
+    d, f = dem[1:-1, :-2], dem[1:-1, 2:]
+    g, h, i = dem[2:, :-2], dem[2:, 1:-1], dem[2:, 2:]
+    dzdx = ((c + 2 * f + i) - (a + 2 * d + g)) / (8 * dx)
+    dzdy = ((g + 2 * h + i) - (a + 2 * b + c)) / (8 * dy)
+    return dzdx, dzdy
+
+
+def calculate_slope(dem: np.array, transform):
+    ''' slope (m/km) of the interior of a DEM with a one-pixel halo, see horn_gradient '''
+    dzdx, dzdy = horn_gradient(dem, transform)
+    return np.sqrt(dzdx ** 2 + dzdy ** 2)
+
+
+def calculate_aspect(dzdx: np.array, dzdy: np.array):
+    ''' downslope direction in degrees clockwise from north, nan for flat pixels '''
+    aspect = np.degrees(np.arctan2(-dzdx, dzdy)) % 360
+    aspect[(dzdx == 0) & (dzdy == 0)] = np.nan
+    return aspect
+
+
+def block_average(array: np.array, factor: int):
+    ''' average factor x factor blocks of array, ignoring nan; edges are padded with nan '''
+    if factor == 1:
+        return array
+    height = math.ceil(array.shape[0] / factor) * factor
+    width = math.ceil(array.shape[1] / factor) * factor
+    padded = np.full((height, width), np.nan)
+    padded[:array.shape[0], :array.shape[1]] = array
+    padded = padded.reshape(height // factor, factor, width // factor, factor)
+    valid = (~np.isnan(padded)).sum(axis=(1, 3))
+    total = np.nansum(padded, axis=(1, 3))
+    return np.where(valid > 0, total / np.maximum(valid, 1), np.nan)
+
+
+def terrain_hydrology(dem: np.array, transform, mask: np.array):
+    '''
+    Topographic wetness index and drainage density of the basin, from D8 flow routing (richdem) on the depression
+    filled DEM. Cells outside the basin are set to nodata, so flow is routed within the basin only.
+
+    :param dem: basin DEM (no halo), nan for nodata
+    :param transform: transform of dem
+    :param mask: basin mask of dem
+    :return: {'twi_mean': mean of ln(a / tan(b)), 'drainage_density': channel length / basin area (km/km2)}
+    '''
+    rows = np.arange(dem.shape[0])
+    lats = transform.f + (rows + 0.5) * transform.e
+    dx = abs(transform.a) * km_per_degree * np.cos(np.deg2rad(lats))[:, np.newaxis]
+    dy = abs(transform.e) * km_per_degree
+    cell_area = np.broadcast_to(dx * dy, dem.shape)  # km2
+    cell_width = np.sqrt(cell_area)  # km
+    valid = mask & ~np.isnan(dem)
+    if not valid.any():
+        return {'twi_mean': np.nan, 'drainage_density': np.nan}
+
+    rd_dem = rd.rdarray(np.where(valid, dem, -9999), no_data=-9999)
+    rd_dem.geotransform = list(transform.to_gdal())
+    filled = rd.FillDepressions(rd_dem, epsilon=True, in_place=False)
+    weights = np.where(valid, cell_area, 0)
+    accumulation = np.array(rd.FlowAccumulation(filled, method='D8', weights=weights))  # upstream area, km2
+
+    halo = rasterio.windows.Window(-1, -1, dem.shape[1] + 2, dem.shape[0] + 2)
+    tan_slope = calculate_slope(np.pad(dem, 1, mode='edge'), rasterio.windows.transform(halo, transform)) / 1000
+    tan_slope = np.maximum(np.nan_to_num(tan_slope, nan=0), 1e-3)
+    specific_catchment_area = accumulation * 1000 / cell_width  # m2 / m
+    twi = np.log(specific_catchment_area / tan_slope)
+
+    channels = valid & (accumulation >= channel_area_km2)
+    return {'twi_mean': np.mean(twi[valid]),
+            'drainage_density': np.sum(cell_width[channels]) / np.sum(cell_area[valid])}
+
+
+def slope_tile_path(slope_folder: str, key: tuple):
+    return os.path.join(slope_folder, f'slope_N{key[0]:02d}E{key[1]:03d}.tif')
+
+
+def build_slope_raster(mosaic: DemMosaic, slope_folder: str, slope_vrt_file: str):
+    '''
+    Compute slope once over the whole DEM collection, one output tile per ASTER tile. Each tile is computed from the
+    mosaic with a one-pixel halo, so there are no seams at tile edges. Output tiles are tiled, DEFLATE compressed
+    GeoTIFFs with internal overviews, joined by slope_vrt_file.
+
+    Rebuilds are incremental: a tile is only recomputed if it is missing, older than its DEM tile, or its
+    neighbouring DEM tiles (i.e. its halo) were added, removed or replaced since it was written.
+    '''
+    if not os.path.isdir(slope_folder):
+        os.makedirs(slope_folder)
+    slope_tifs = []
+    for key, dem_tif in tqdm(sorted(mosaic.tile_index.items())):
+        N, E = key
+        # the halo tiles and their mtimes, so a replaced neighbour also invalidates the tile
+        neighbours = ','.join(f'{N + i}_{E + j}:{int(os.path.getmtime(mosaic.tile_index[(N + i, E + j)]))}'
+                              for i in (-1, 0, 1) for j in (-1, 0, 1)
+                              if (i, j) != (0, 0) and (N + i, E + j) in mosaic.tile_index)
+        out_tif = slope_tile_path(slope_folder, key)
+        slope_tifs.append(out_tif)
+        if os.path.isfile(out_tif) and os.path.getmtime(out_tif) >= os.path.getmtime(dem_tif):
+            with rasterio.open(out_tif) as src:
+                if src.tags().get('NEIGHBOURS') == neighbours:
+                    continue
+        dem, transform = mosaic.read((E, N, E + 1, N + 1), halo=1)
+        dem = dem.astype(np.float64)
+        dem[dem == mosaic.nodata] = np.nan
+        slope = calculate_slope(dem, transform).astype(np.float32)
+        interior = rasterio.windows.Window(1, 1, slope.shape[1], slope.shape[0])
+        with rasterio.open(out_tif, 'w', driver='GTiff', height=slope.shape[0], width=slope.shape[1], count=1,
+                           dtype='float32', crs=mosaic.src.crs, transform=rasterio.windows.transform(interior, transform),
+                           nodata=np.nan, tiled=True, blockxsize=256, blockysize=256, compress='deflate',
+                           predictor=3) as dst:
+            dst.write(slope, 1)
+            dst.update_tags(NEIGHBOURS=neighbours)
+            dst.build_overviews([2, 4, 8, 16], Resampling.average)
+    vrt = gdal.BuildVRT(slope_vrt_file, slope_tifs)
+    vrt = None
+    return slope_vrt_file
+
+
+def basin_terrain(shpfile: str, mosaic: DemMosaic, slope_src=None, block_rows=1024, block_cols=1024):
+    '''
+    Single streaming pass over the DEM window of the basin. Each block fills the elevation and slope histograms and
+    the aspect sums, and is block averaged into a basin DEM of at most max_terrain_pixels pixels that is used for
+    flow routing, so the hydrological attributes cost no extra read.
+
+    :param slope_src: opened precomputed slope raster (see build_slope_raster), slope is computed from the DEM
+                      strips if None
+    :return: {'elev_hist', 'slope_hist', 'aspect_mean', 'twi_mean', 'drainage_density'}
+    '''
+    needed_range = fetch_shapefile_needed_DEM_range(shpfile)
+    print(f"-> {os.path.basename(shpfile)}: lat range: {needed_range['Ns']}, lon range: {needed_range['Es']}")
+    mosaic.needed_tifs(shpfile)
+    shapes = basin_shapes(shpfile)
+    bounds = shapefile_bounds(shpfile)
+    elev_hist = StreamingHistogram(*elev_bins)
+    slope_hist = StreamingHistogram(*slope_bins)
+    aspect_sin, aspect_cos = 0., 0.
+
+    # decimation factor of the flow routing DEM, blocks are aligned to it
+    window = bounds_window(mosaic.src, bounds)
+    factor = max(1, math.ceil(math.sqrt(window.width * window.height / max_terrain_pixels)))
+    block_rows = math.ceil(block_rows / factor) * factor
+    block_cols = math.ceil(block_cols / factor) * factor
+    coarse_dem = np.full((math.ceil(window.height / factor), math.ceil(window.width / factor)), np.nan)
+
+    blocks = iter_basin_blocks(mosaic.src, shapes, bounds, block_rows=block_rows, block_cols=block_cols, halo=1,
+                               nodata=mosaic.nodata)
+    for block in blocks:
+        dem = block['array'][1:-1, 1:-1]
+        elev_hist.update(dem[block['mask']])
+        dzdx, dzdy = horn_gradient(block['array'], block['transform'])
+        if slope_src is None:
+            slope_hist.update(np.sqrt(dzdx ** 2 + dzdy ** 2)[block['mask']])
+        aspect = calculate_aspect(dzdx, dzdy)[block['mask']]
+        aspect = np.radians(aspect[~np.isnan(aspect)])
+        aspect_sin += np.sum(np.sin(aspect))
+        aspect_cos += np.sum(np.cos(aspect))
+        row, col = block['row'] // factor, block['col'] // factor
+        coarse = block_average(dem, factor)
+        coarse_dem[row:row + coarse.shape[0], col:col + coarse.shape[1]] = coarse
+    if slope_src is not None:
+        for block in iter_basin_blocks(slope_src, shapes, bounds, block_rows=block_rows, block_cols=block_cols,
+                                       nodata=slope_src.nodata):
+            slope_hist.update(block['array'][block['mask']])
+
+    coarse_transform = mosaic.src.window_transform(window) * Affine.scale(factor)
+    coarse_mask = rasterio.features.geometry_mask(shapes, out_shape=coarse_dem.shape, transform=coarse_transform,
+                                                  invert=True)
+    res = {'elev_hist': elev_hist, 'slope_hist': slope_hist,
+           'aspect_mean': np.degrees(np.arctan2(aspect_sin, aspect_cos)) % 360 if aspect_sin or aspect_cos else np.nan}
+    res.update(terrain_hydrology(coarse_dem, coarse_transform, coarse_mask))
     return res
 
 
-def calculate_slope(DEM):
-    ''' calculate the slope of a given dem '''
-    dem_path = DEM
-    shasta_dem = rd.LoadGDAL(dem_path, no_data=-128)
-    slope = rd.TerrainAttribute(shasta_dem, attrib='slope_riserun')
-    return np.array(slope.data)
-
-
-def slope_mean(shpfile: str, dem_folder: str):
-    ''' calculate the slope of a given catchment '''
-    # if os.path.isfile(tmp_merged):
-    #     os.remove(tmp_merged)
-    # if os.path.isfile(tmp_reprojected):
-    #     os.remove(tmp_reprojected)
-    # get needed N E range
-    needed_Ns = fetch_shapefile_needed_DEM_range(shpfile)['Ns']
-    needed_Es = fetch_shapefile_needed_DEM_range(shpfile)['Es']
-
-    # get needed tifs
-    files = absolute_file_paths(dem_folder)
-    files = [file for file in files if file.endswith('.tif')]
-
-    needed_tifs = []
-    for file in files:
-        N = load_N_E_from_dem_name(file)['N']
-        E = load_N_E_from_dem_name(file)['E']
-        if (N in needed_Ns) and (E in needed_Es):
-            needed_tifs.append(file)
-
-    # merge tifs
-    merge_tifs(needed_tifs, tmp_merged)
-    reproject_tif(tmp_merged, tmp_reprojected)
-
-    # get slope
-    slope = calculate_slope(tmp_reprojected)
-
-    # rise (m, dem) / run (degree, coordinates)
-    slope = slope / 111  # 1 degree = 111km
-
-    # get raster range
-    ds = gdal.Open(tmp_reprojected)
-    width = ds.RasterXSize
-    height = ds.RasterYSize
-    gt = ds.GetGeoTransform()
-    minx = gt[0]
-    miny = gt[3] + width * gt[4] + height * gt[5]
-    maxx = gt[0] + width * gt[1] + height * gt[2]
-    maxy = gt[3]
-    ds = None
-
-    # write slope tif
-    geotif_from_array(slope, lat_start=miny, lat_end=maxy, lon_start=minx, lon_end=maxx, degree=0.1,
-                      output_file=tmp_slope)
-
-    # zonal stats
-    try:
-        res = zonal_stats_singletif(tmp_slope, shpfile)
-    except ValueError as e:
-        print(e)
-        print('->', needed_Es, needed_Ns, needed_tifs)
-        return np.nan
+def elev_slope_stats(shpfile: str, mosaic: DemMosaic, slope_src=None):
+    ''' terrain attributes of the catchment, all derived from one pass over its DEM window '''
+    terrain = basin_terrain(shpfile, mosaic, slope_src=slope_src)
+    elev_hist, slope_hist = terrain['elev_hist'], terrain['slope_hist']
+    return {'elev': elev_hist.mean(),
+            'elev_5': elev_hist.percentile(5),
+            'elev_50': elev_hist.percentile(50),
+            'elev_95': elev_hist.percentile(95),
+            'hypsometric_integral': elev_hist.hypsometric_integral(),
+            'slope': slope_hist.mean(),
+            'slope_5': slope_hist.percentile(5),
+            'slope_50': slope_hist.percentile(50),
+            'slope_95': slope_hist.percentile(95),
+            'aspect_mean': terrain['aspect_mean'],
+            'twi_mean': terrain['twi_mean'],
+            'drainage_density': terrain['drainage_density']}
+
+
+def init_worker(dem_folder: str, catalog_file: str, dem_vrt_file: str, slope_vrt_file=None):
+    ''' every worker process opens its own handle on the DEM mosaic (and the precomputed slope raster) '''
+    global worker_mosaic, worker_slope_src
+    worker_mosaic = DemMosaic(dem_folder, catalog_file, dem_vrt_file)
+    worker_slope_src = rasterio.open(slope_vrt_file) if slope_vrt_file is not None else None
+
+
+def worker_elev_slope_stats(shpfile: str):
+    res = {'shp_id': shp_id(shpfile)}
+    res.update(elev_slope_stats(shpfile, worker_mosaic, worker_slope_src))
     return res
 
 
-def main(outpath):
-    res = []
-    # print(len([file for file in absolute_file_paths(shp_folfer) if file.endswith('.shp')]))
-    shps = [file for file in absolute_file_paths(shp_folfer) if file.endswith('.shp')][:1]
-    for shpfile in tqdm(shps):
-        tmp_res = {'shp_id': shp_id(shpfile), 'elev': elev_mean(shpfile, dem_folder),
-                   'slope': slope_mean(shpfile, dem_folder)}
-        res.append(tmp_res)
+def main(outpath, num_workers=1, precomputed_slope=False):
+    '''
+    :param outpath: output xlsx
+    :param num_workers: number of worker processes, basins are processed in parallel when > 1, all intermediate
+                        rasters are kept in memory so workers do not share any scratch file
+    :param precomputed_slope: build (or incrementally update) the slope raster of the whole DEM collection and read
+                              basin slope from it
+    '''
+    shps = [file for file in absolute_file_paths(shp_folfer) if file.endswith('.shp')]
+    # refresh the tile index and build the vrts once, before any worker opens them; tiles added since the last run
+    # are picked up here, and only their slope tiles (and those of their neighbours) are recomputed
+    with DemMosaic(dem_folder, catalog_file, dem_vrt_file, refresh=True) as mosaic:
+        slope_vrt = build_slope_raster(mosaic, slope_folder, slope_vrt_file) if precomputed_slope else None
+    init_args = (dem_folder, catalog_file, dem_vrt_file, slope_vrt)
+    if num_workers > 1:
+        with Pool(num_workers, initializer=init_worker, initargs=init_args) as pool:
+            res = list(tqdm(pool.imap(worker_elev_slope_stats, shps), total=len(shps)))
+    else:
+        init_worker(*init_args)
+        res = [worker_elev_slope_stats(shpfile) for shpfile in tqdm(shps)]
     res = pd.DataFrame(res).rename(columns={'shp_id': 'basin_id'})
     res.to_excel(outpath, index=None)
 
@@ -177,12 +483,8 @@ if __name__ == '__main__':
     dem_folder = './data/dems'
     shp_folfer = './shapefiles'
     outpath = './output/elev_slope.xlsx'
-
-    tmp_merged = 'merge_cache.tif'  # no need to change
-    tmp_reprojected = 'reproject_cache.tif'  # no need to change
-    tmp_slope = 'slope_cache.tif'  # no need to change
-    main(outpath)
-
-    os.remove(tmp_merged)
-    os.remove(tmp_reprojected)
-    os.remove(tmp_slope)
+    dem_vrt_file = './data/dems.vrt'
+    slope_folder = './data/slope'
+    slope_vrt_file = './data/slope.vrt'
+    num_workers = os.cpu_count()
+    main(outpath, num_workers=num_workers, precomputed_slope=True)
@@ -1,6 +1,7 @@
 import os, datetime, subprocess, shutil, re, sys
 
 from utils import *
+from catalog import DataCatalog, catalog_file
 
 '''
 Calculate catchment-scale NDVI/LAI time-series based on MODIS.
@@ -92,23 +93,24 @@ def group_hdf_files_by_date(hdf_files: list):
     return res
 
 
-def hdf_to_tif(hdf_file: str, output_dir: str):
+def hdf_to_tif(hdf_file: str, output_dir: str, subdatasets=None):
     '''
 
     :param hdf_file: hdf file
-    :param output_dir: convert hdf file to tifs
-    :return:
+    :param output_dir: convert hdf file to tifs, one per subdataset, named <hdf name>_<1-based subdataset index>.tif
+    :param subdatasets: 1-based indices of the subdatasets to convert, None for all
+    :return: tif paths
     '''
-    cwd = os.getcwd()
-    if not os.path.isdir(output_dir):
-        os.makedirs(output_dir)
-    os.chdir(output_dir)
-    name = os.path.basename(hdf_file)[:-4] + '.tif'
-    command = f'gdal_translate -sds -of GTiff {os.path.basename(hdf_file)} {name}'
-    process = subprocess.Popen(command.split(), stdout=subprocess.PIPE)
-    output, error = process.communicate()
-    os.chdir(cwd)
-    return name
+    ds = gdal.Open(hdf_file)
+    tifs = []
+    for i, (name, _) in enumerate(ds.GetSubDatasets()):
+        if subdatasets is not None and i + 1 not in subdatasets:
+            continue
+        tif = os.path.join(output_dir, f'{os.path.basename(hdf_file)[:-4]}_{i + 1}.tif')
+        gdal.Translate(tif, name, format='GTiff')
+        tifs.append(tif)
+    ds = None
+    return tifs
 
 
 def group_tif_files_by_date_feature(files: list):
@@ -117,29 +119,15 @@ def group_tif_files_by_date_feature(files: list):
     :param files: tif files
     :return: group tifs by date and feature
     '''
-    dates = [get_info_from_modis_tif(file)['date'] for file in files]
-    unique_dates = np.unique(dates)
-    features = [get_info_from_modis_tif(file)['feature'] for file in files]
-    unique_features = np.unique(features)
-    res = {}
-    for date in unique_dates:
-        res[date] = {}
-        for feature in unique_features:
-            res[date][feature] = [file for file in files if date == get_info_from_modis_tif(file)['date'] and
-                                  feature == get_info_from_modis_tif(file)['feature']]
+    infos = [get_info_from_modis_tif(file) for file in files]
+    unique_dates = np.unique([info['date'] for info in infos])
+    unique_features = np.unique([info['feature'] for info in infos])
+    res = {date: {feature: [] for feature in unique_features} for date in unique_dates}
+    for file, info in zip(files, infos):
+        res[info['date']][info['feature']].append(file)
     return res, unique_features
 
 
-def get_84_tifs(folder: str):
-    '''
-
-    :param folder: tifs folder
-    :return: return only tifs in wgs84
-    '''
-    files = absolute_file_paths(folder)
-    return [file for file in files if 'tif84' in file]
-
-
 def zonal_stats(tif_file: str, shape_file: str, valid_min, valid_max) -> dict:
     '''
 
@@ -161,60 +149,46 @@ def zonal_stats(tif_file: str, shape_file: str, valid_min, valid_max) -> dict:
         return {'mean': 0, 'max': 0, 'min': 0}
 
 
-def clear_dir(folder: str):
-    '''
-
-    :param folder: folder path
-    :return: None
-    '''
-    shutil.rmtree(folder)
-    print(f'-> {folder} cleared')
-
-
 class Modis():
-    def __init__(self, hdf_folder, working_folder, tmp_folder, product, zones):
-        self.hdf_folder = hdf_folder
+    def __init__(self, hdf_files, working_folder, scratch: Scratch, product, zones):
+        '''
+        :param hdf_files: hdfs of one date
+        :param scratch: scratch space of the intermediate tifs
+        '''
+        self.hdf_files = hdf_files
         self.working_folder = working_folder
-        self.tmp_folder = tmp_folder
+        self.scratch = scratch
         self.product = product
         self.zones = zones
         self.merged_tif_names = []
-        print('tmp_folder: ', tmp_folder)
+        print('hdf_files: ', len(hdf_files))
         print('product: ', product)
         print('zones: ', zones)
         print('---------------------')
 
-    def get_merged_tifs(self, merged_tifs_folder: str, feature_name: str, feature_index: str) -> pd.DataFrame:
+    def get_merged_tifs(self, feature_name: str, feature_index: str) -> pd.DataFrame:
         print('feature_index: ', feature_index)
         print('feature_name: ', feature_name)
         print('----------------------')
-        print('clear the tmp folder, if not exists, creat one')
-        files = absolute_file_paths(self.tmp_folder)
-        # files = get_qualified_hdf_files_from_folder(self.hdf_folder, self.product, self.zones)
         print('convert hdf to tif...')
-        for file in tqdm(files, position=0, leave=True, file=sys.stdout):
-            hdf_to_tif(file, tmp_dir)
+        tifs = []
+        for file in tqdm(self.hdf_files, position=0, leave=True, file=sys.stdout):
+            tifs += hdf_to_tif(file, self.scratch.folder('tifs'), subdatasets=[int(feature_index)])
         print('downscale tif...')
-        for file in absolute_file_paths(tmp_dir):
-            if file.endswith('.tif'):
-                gdal_downsample_tif(file, tmp_dir, 50)
-        print('reproject tif to wgs84')
-        tifs = [file for file in absolute_file_paths(tmp_dir) if
-                (file.endswith('.tif') and '_downscaled' in file)]
-        for file in tqdm(tifs, position=0, leave=True, file=sys.stdout):
-            name = file + '84.tif'
-            reproject_tif(file, name)
-        tifs_84 = get_84_tifs(tmp_dir)
-        groups, unique_features = group_tif_files_by_date_feature(tifs_84)
-        print('merge tif...')
-        if not os.path.isdir(merged_tifs_folder):
-            os.makedirs(merged_tifs_folder)
+        downscaled = []
+        for file in tifs:
+            downscaled_tif = self.scratch.path(os.path.basename(file)[:-4] + '_downscaled.tif')
+            downscaled.append(downsample_raster(file, downscaled_tif, 50, resampling='nearest'))
+            os.remove(file)
+        groups, unique_features = group_tif_files_by_date_feature(downscaled)
+        print('merge tif (reprojected to wgs84 on the fly)...')
         merged_tifs = {}
         for date in tqdm(groups.keys(), position=0, leave=True, file=sys.stdout):
             merged_tifs[date] = {}
-            merged_tif_name = f'{self.product}-{date.year}.{date.month}.{date.day}-{feature_name}-merged.tif'
-            merged_tif_name = os.path.join(merged_tifs_folder, merged_tif_name)
-            merge_tifs(groups[date][feature_index], merged_tif_name)
+            merged_tif_name = self.scratch.path(
+                f'{self.product}-{date.year}.{date.month}.{date.day}-{feature_name}-merged.tif')
+            merge_tifs(groups[date][feature_index], merged_tif_name, warp_crs='EPSG:4326',
+                       num_threads=os.cpu_count())
             merged_tifs[date][feature_name] = merged_tif_name
             self.merged_tif_names.append(merged_tif_name)
         return pd.DataFrame(merged_tifs).T
@@ -222,18 +196,18 @@ class Modis():
     def zonal_stats_by_shapefile(self, shapefile: str, valid_min=0, valid_max=100):
         res = {}
         for file in self.merged_tif_names:
-            date = file.split('-')[1]
+            date = os.path.basename(file).split('-')[1]
             year = int(date.split('.')[0])
             month = int(date.split('.')[1])
             day = int(date.split('.')[2])
             date = datetime.datetime(year, month, day)
-            feature = file.split('-')[2]
+            feature = os.path.basename(file).split('-')[2]
             stats = zonal_stats(tif_file=file, shape_file=shapefile, valid_min=valid_min, valid_max=valid_max)['mean']
             res[date] = {feature: stats}
         return stats
 
     def clear_tmp(self):
-        shutil.rmtree(tmp_dir)
+        self.scratch.clear()
 
 
 def get_hdf_product(file):
@@ -266,48 +240,36 @@ def summary_year(year, data_root, out_dir, root_dir):
     :param root_dir: data processing root dir
     :return: xlsx files
     '''
-    start = datetime.datetime(year, 1, 1)
-    end = datetime.datetime(year, 12, 31)
-
-    if os.path.exists(tmp_dir):
-        clear_dir(tmp_dir)
-        os.makedirs(tmp_dir)
-    else:
-        os.makedirs(tmp_dir)
-
-    files = absolute_file_paths(data_root)
-    files = [file for file in files if file.endswith('.hdf')]
+    # hdfs of the year from the data catalog, grouped by date
+    with DataCatalog(catalog_file) as catalog:
+        files = catalog.files('modis', data_root, ext='hdf', year=year)
+    files_by_date = {}
+    for file in files:
+        files_by_date.setdefault(get_hdf_date(file), []).append(file)
 
     res = {}
-    for date in tqdm(np.unique([get_hdf_date(file) for file in files])):
-        if not start <= date <= end:
-            continue
-
-        print(date, '...')
-        for file in files:
-            if get_hdf_date(file) == date:
-                shutil.copyfile(file, f'{tmp_dir}/{os.path.basename(file)}')
-
-        modis = Modis(hdf_folder=tmp_dir,
-                      working_folder=root_dir,
-                      tmp_folder=tmp_dir,
-                      product='MCD15A3H',
-                      zones='all')
-        modis.get_merged_tifs(merged_tifs_folder=tmp_dir,
-                              feature_name='LAI',
-                              feature_index='2')
-
-        for shape_file in [file for file in absolute_file_paths(shp_dir) if file.endswith('.shp')]:
-            id = shp_id(shape_file)
-            tmp_res = modis.zonal_stats_by_shapefile(shapefile=shape_file,
-                                                     valid_min=-0,
-                                                     valid_max=100)
-            if id not in res:
-                res[id] = {}
-            res[id][date] = tmp_res
-
-        clear_dir(tmp_dir)
-        os.makedirs(tmp_dir)
+    # intermediate tifs live in a private scratch space (tmpfs when possible), removed even on error
+    with Scratch('lai') as scratch:
+        for date in tqdm(sorted(files_by_date)):
+            print(date, '...')
+            modis = Modis(hdf_files=files_by_date[date],
+                          working_folder=root_dir,
+                          scratch=scratch,
+                          product='MCD15A3H',
+                          zones='all')
+            modis.get_merged_tifs(feature_name='LAI',
+                                  feature_index='2')
+
+            for shape_file in [file for file in absolute_file_paths(shp_dir) if file.endswith('.shp')]:
+                id = shp_id(shape_file)
+                tmp_res = modis.zonal_stats_by_shapefile(shapefile=shape_file,
+                                                         valid_min=-0,
+                                                         valid_max=100)
+                if id not in res:
+                    res[id] = {}
+                res[id][date] = tmp_res
+
+            modis.clear_tmp()
 
     final_res = {}
     for key in res:
@@ -319,10 +281,12 @@ def summary_year(year, data_root, out_dir, root_dir):
 
 
 shp_dir = './shapefiles'
-tmp_dir = './tmp'
 if __name__ == '__main__':
     print('-> lai time series')
     res = {}
+    # pick up newly downloaded hdfs once, every year is then an indexed lookup
+    with DataCatalog(catalog_file) as catalog:
+        catalog.index('modis', './data/MCD15A3H', refresh=True)
     for year in range(2002, 2003):
         if not os.path.isdir(f'./output/lai/{year}'):
             os.mkdir(f'./output/lai/{year}')
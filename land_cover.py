@@ -23,6 +23,9 @@ The directory should be structured as follows:
 |   ├── basin_0001.shp
 ├── data
 |   ├── processed_igbp.tif
+|   ├── igbp_annual (optional, yearly fractions in igbp_annual.xlsx)
+|   |   ├── processed_igbp_2001.tif
+|   |   ├── processed_igbp_2002.tif
 ├── output
 
 '''
@@ -73,7 +76,97 @@ def modis_land_cover_igbp_name2number(name: str):
     return names.index(name)
 
 
-def igbp_stats(shapefile: str, igbp_tif: str, nan_value=255):
+igbp_classes = 18
+
+# years of the annual rasters, e.g. ./data/igbp_annual/processed_igbp_2001.tif
+annual_igbp_dir = './data/igbp_annual'
+
+# per-basin class counts shared by land_cover.py and rooting_depth.py, see basin_class_counts
+class_counts_file = './cache/igbp_class_counts.csv'
+
+
+def igbp_codes(values: np.array, nan_value=255) -> np.array:
+    '''
+    :return: histogram bin of every pixel value: the value for 0..17, igbp_classes for any other code and
+             igbp_classes + 1 for pixels left out (nan_value and negative values such as -9999)
+    '''
+    codes = np.minimum(values, igbp_classes).astype(np.int64)
+    codes[(values < 0) | (values == nan_value)] = igbp_classes + 1
+    return codes
+
+
+def igbp_class_counts(shapefile: str, igbp_tif: str, nan_value=255, engine: ZonalEngine = None) -> np.array:
+    '''
+    Pixel count of every IGBP value inside the basin, from one integer histogram. Land cover fractions (igbp_stats)
+    and rooting depth (see rooting_depth.py) are both derived from these counts.
+
+    :return: counts of length igbp_classes + 1, counts[i] is the number of pixels of value i and the last item the
+             number of pixels of any other code (nan_value and -9999 left out)
+    '''
+    if engine is None:
+        # same pixels as the masked extraction, as a flat array and for any dtype (a -9999 fill does not fit uint8)
+        engine = ZonalEngine()
+    res = engine.values(igbp_tif, shapefile)
+    return np.bincount(igbp_codes(res, nan_value), minlength=igbp_classes + 2)[:igbp_classes + 1]
+
+
+def load_class_counts(igbp_tif: str, counts_file=class_counts_file) -> dict:
+    ''' :return: {shape file: counts} stored for igbp_tif, counts older than the raster or the shapefile left out '''
+    if not os.path.isfile(counts_file):
+        return {}
+    table = pd.read_csv(counts_file)
+    table = table[table['igbp_tif'] == os.path.abspath(igbp_tif)]
+    columns = [str(i) for i in range(igbp_classes + 1)]
+    res = {}
+    for _, row in table.iterrows():
+        shape_file = row['shape_file']
+        if os.path.isfile(shape_file) and \
+                row['computed'] >= max(os.path.getmtime(shape_file), os.path.getmtime(igbp_tif)):
+            res[shape_file] = row[columns].values.astype(np.int64)
+    return res
+
+
+def save_class_counts(counts: dict, igbp_tif: str, counts_file=class_counts_file):
+    ''' add {shape file: counts} of igbp_tif to counts_file, replacing older counts of the same basin and raster '''
+    igbp_tif = os.path.abspath(igbp_tif)
+    table = pd.DataFrame([[shape_file, igbp_tif, time.time()] + list(count) for shape_file, count in counts.items()],
+                         columns=['shape_file', 'igbp_tif', 'computed'] + [str(i) for i in range(igbp_classes + 1)])
+    if os.path.isfile(counts_file):
+        old = pd.read_csv(counts_file)
+        old = old[~(old['igbp_tif'] == igbp_tif) | ~old['shape_file'].isin(list(counts))]
+        table = pd.concat([old, table], ignore_index=True)
+    folder = os.path.dirname(os.path.abspath(counts_file))
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    # written aside and renamed, the other script never reads a partial table
+    table.to_csv(counts_file + '.tmp', index=False)
+    os.replace(counts_file + '.tmp', counts_file)
+
+
+def basin_class_counts(shape_files: list, igbp_tif: str, num_workers=1, counts_file=class_counts_file) -> dict:
+    '''
+    IGBP class counts of every basin. Counts stored in counts_file by an earlier run of land_cover.py or
+    rooting_depth.py are reused; only the missing basins are read, and the table is updated, so the IGBP raster is
+    read once per basin for both scripts.
+
+    :return: {shape file: counts} (see igbp_class_counts)
+    '''
+    counts = load_class_counts(igbp_tif, counts_file)
+    missing = [shape_file for shape_file in shape_files if shape_file not in counts]
+    if len(missing) > 0:
+        tasks = [(shape_file, igbp_tif) for shape_file in missing]
+        new = dict(map_basins(worker_igbp_class_counts, tasks, init_worker, ('./cache/masks',), num_workers,
+                              tif_files=[igbp_tif], shape_files=missing))
+        save_class_counts(new, igbp_tif, counts_file)
+        counts.update(new)
+    return {shape_file: counts[shape_file] for shape_file in shape_files}
+
+
+def igbp_stats(shapefile: str, igbp_tif: str, nan_value=255, engine: ZonalEngine = None, counts=None):
+    '''
+    :param counts: class counts of the basin (see igbp_class_counts), read from igbp_tif if None
+    :return: {land cover name: fraction of the basin pixels}
+    '''
     names = ['Evergreen needleleaf tree',
              'Evergreen broadleaf tree',
              'Deciduous needleleaf tree',
@@ -92,35 +185,137 @@ def igbp_stats(shapefile: str, igbp_tif: str, nan_value=255):
              'Barren',
              'Water bodies']
 
-    res = extract_raster_by_shape_file(raster=igbp_tif, shape_file=shapefile, output_file=None)
-    res = res[res != -9999].flatten()
-    res_list = res[res != nan_value].flatten().tolist()
-    res_str = [modis_land_cover_igbp_number2name(number) for number in res_list]
-    land_class, count = np.unique(res_str, return_counts=True)
-    land_class_rank = [x for _, x in sorted(zip(count, land_class), reverse=True) if x != 'nan']
+    if counts is None:
+        counts = igbp_class_counts(shapefile, igbp_tif, nan_value=nan_value, engine=engine)
+    # values 1..17 are the classes and 0 has always been named names[-1] by modis_land_cover_igbp_number2name;
+    # other codes have no name but still count in the basin total
+    count = counts[1:igbp_classes].astype(np.float64)
+    count[-1] += counts[0]
 
     res = {}
     for name in names:
         res[name] = 0
-    for num, name in zip(count, land_class):
-        if name != 'nan':
-            res[name] = num / np.sum(count)
+    if np.sum(counts) > 0:
+        for name, fraction in zip(names, count / np.sum(counts)):
+            if fraction > 0:
+                res[name] = fraction
 
     # print('shapefile:', shapefile)
     # print(res)
     return res
 
 
+def igbp_stack_stats(shapefile: str, igbp_tifs: dict, nan_value=255, engine: ZonalEngine = None,
+                     transitions=False):
+    '''
+    Land cover fractions of every year of a stack of annual IGBP rasters in one pass. Rasters are grouped by grid,
+    the basin mask is looked up once per grid and reused for every year on it.
+
+    :param igbp_tifs: {year: igbp tif}
+    :param transitions: also count the class transitions between consecutive years on the same grid
+    :return: {year: fractions (see igbp_stats)}, and if transitions {(year, next year): DataFrame of pixel counts,
+             from-class rows and to-class columns} of pixels classified in both years
+    '''
+    if engine is None:
+        engine = ZonalEngine()
+    names = [modis_land_cover_igbp_number2name(index) for index in range(1, igbp_classes)]
+    groups = {}
+    for year in sorted(igbp_tifs):
+        groups.setdefault(MaskCache.grid_key(engine.raster(igbp_tifs[year])), []).append(year)
+
+    fractions = {}
+    changes = {}
+    for years in groups.values():
+        window, index = engine.mask(igbp_tifs[years[0]], shapefile)
+        previous = None
+        for year in years:
+            if window is None:
+                codes = np.array([], dtype=np.int64)
+            else:
+                codes = igbp_codes(engine.raster(igbp_tifs[year]).read(1, window=window).ravel()[index], nan_value)
+            counts = np.bincount(codes, minlength=igbp_classes + 2)[:igbp_classes + 1]
+            fractions[year] = igbp_stats(shapefile, igbp_tifs[year], nan_value, counts=counts)
+            if transitions:
+                # classes 1..17 as rows/columns, 0 folded into water bodies as in igbp_stats
+                classes = np.where(codes == 0, igbp_classes - 1, codes) - 1
+                if previous is not None:
+                    both = (previous < igbp_classes - 1) & (classes < igbp_classes - 1)
+                    matrix = np.bincount(previous[both] * (igbp_classes - 1) + classes[both],
+                                         minlength=(igbp_classes - 1) ** 2).reshape(igbp_classes - 1, -1)
+                    changes[(previous_year, year)] = pd.DataFrame(matrix, index=names, columns=names)
+                previous, previous_year = classes, year
+    if transitions:
+        return fractions, changes
+    return fractions
+
+
+def annual_igbp_tifs(folder=annual_igbp_dir) -> dict:
+    ''' :return: {year: tif} of the annual IGBP rasters in folder, the year taken from the file name '''
+    res = {}
+    if os.path.isdir(folder):
+        for file in absolute_file_paths(folder):
+            year = re.findall(r'(\d{4})', os.path.basename(file))
+            if file.endswith('.tif') and len(year) > 0:
+                res[int(year[-1])] = file
+    return res
+
+
+def init_worker(specs: dict, mask_cache_dir: str):
+    global worker_engine
+    worker_engine = ZonalEngine(MaskCache(mask_cache_dir), shared_rasters=attach_rasters(specs))
+
+
+def worker_igbp_class_counts(args):
+    shape_file, igbp_tif = args
+    return shape_file, igbp_class_counts(shape_file, igbp_tif, engine=worker_engine)
+
+
+def worker_igbp_stack_stats(args):
+    shape_file, igbp_tifs, transitions = args
+    return shp_id(shape_file), igbp_stack_stats(shape_file, igbp_tifs, engine=worker_engine, transitions=transitions)
+
+
+def column_name(name: str):
+    return name.lower().replace(' ', '_')
+
+
 if __name__ == '__main__':
     print('-> land cover')
     igbp_tif = "./data/processed_igbp.tif"
     shp_dir = './shapefiles'
     out = './output/igbp.xlsx'
+    out_annual = './output/igbp_annual.xlsx'
+    out_transitions = './output/igbp_transitions.xlsx'
+    transitions = False
+    num_workers = os.cpu_count()
 
-    res = {}
-    for shape_file in tqdm(file for file in absolute_file_paths(shp_dir) if file.endswith('.shp')):
-        res[shp_id(shape_file)] = igbp_stats(shapefile=shape_file, igbp_tif=igbp_tif)
+    shps = [file for file in absolute_file_paths(shp_dir) if file.endswith('.shp')]
+    bounds = shapefiles_bounds(shps)
+    igbp_tif = clipped_raster(igbp_tif, bounds=bounds)
+    counts = basin_class_counts(shps, igbp_tif, num_workers)
+    res = {shp_id(shape_file): igbp_stats(shape_file, igbp_tif, counts=count) for shape_file, count in counts.items()}
     res = pd.DataFrame(res).T
-    res.columns = [x.lower().replace(' ', '_') for x in res.columns]
+    res.columns = [column_name(x) for x in res.columns]
     res = res.reset_index().rename(columns={'index': 'basin_id'})
     res.to_excel(out, index=None)
+
+    # yearly fractions if the annual rasters are available, (basin, year, class) rows
+    igbp_tifs = {year: clipped_raster(tif, bounds=bounds) for year, tif in annual_igbp_tifs().items()}
+    if len(igbp_tifs) > 0:
+        print('-> land cover time series')
+        tasks = [(shape_file, igbp_tifs, transitions) for shape_file in shps]
+        res = dict(map_basins(worker_igbp_stack_stats, tasks, init_worker, ({}, './cache/masks'), num_workers))
+        rows = []
+        transition_rows = []
+        for basin_id, stack in res.items():
+            fractions, changes = stack if transitions else (stack, {})
+            for year, fraction in fractions.items():
+                rows += [[basin_id, year, column_name(name), value] for name, value in fraction.items()]
+            for (year_from, year_to), matrix in changes.items():
+                for name_from, row in matrix.iterrows():
+                    transition_rows += [[basin_id, year_from, year_to, column_name(name_from), column_name(name_to),
+                                         count] for name_to, count in row.items() if count > 0]
+        pd.DataFrame(rows, columns=['basin_id', 'year', 'class', 'fraction']).to_excel(out_annual, index=None)
+        if transitions:
+            pd.DataFrame(transition_rows, columns=['basin_id', 'year_from', 'year_to', 'class_from', 'class_to',
+                                                   'pixels']).to_excel(out_transitions, index=None)
@@ -4,9 +4,8 @@ import os
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
-import fiona
-import rasterio
-import rasterio.mask
+
+from utils import ZonalEngine, MaskCache, attach_rasters, clipped_raster, map_basins
 
 '''
 Calculate catchment-scale zonal stats of lithology based on GliM.
@@ -61,32 +60,22 @@ def shp_id(shpfile: str):
     return re.findall(r'[\d]+', shpfile)[-1]
 
 
-def extract_raster(raster: str, shape_file: str, output_file=None, nodata=-9999):
-    with fiona.open(shape_file, "r") as shapefile:
-        shapes = [feature["geometry"] for feature in shapefile]
-    with rasterio.open(raster) as src:
-        out_image, out_transform = rasterio.mask.mask(src, shapes, nodata=nodata, crop=True)
-        out_meta = src.meta
-    if output_file is None:
-        return out_image
-    else:
-        out_meta.update({"driver": "GTiff",
-                         "height": out_image.shape[1],
-                         "width": out_image.shape[2],
-                         "transform": out_transform})
-        with rasterio.open(output_file, "w", **out_meta) as dest:
-            dest.write(out_image)
-        return out_image
-
-
 class Glim():
     def __init__(self, glim_raster_tif: str, glim_cate_number_mapping_file: str, short2long_name_txt: str,
-                 nan_value=65535):
+                 nan_value=65535, mask_cache: MaskCache = None, shared_rasters=None):
         self.glim_raster_tif = glim_raster_tif
         self.short2long_dataframe = pd.read_table(short2long_name_txt, sep=',')
         self.glim_mapping_dataframe = pd.read_table(glim_cate_number_mapping_file, sep=',')
         self.glim_mapping_dataframe['xx'] = [s[:2] for s in self.glim_mapping_dataframe['Litho']]
         self.nan_value = nan_value
+        self.engine = ZonalEngine(mask_cache, shared_rasters=shared_rasters)
+
+        # raster value -> index in geol_classes (-1 if unmapped), same mapping as glim_number2geol_mapping
+        self.geol_classes = np.array(sorted(self.glim_mapping_dataframe['xx'].unique()))
+        mapping = self.glim_mapping_dataframe.drop_duplicates('Value')
+        self.lookup = np.full(int(mapping['Value'].max()) + 1, -1, dtype=np.int64)
+        self.lookup[mapping['Value'].values.astype(np.int64)] = np.searchsorted(self.geol_classes, mapping['xx'])
+        self.counts = {}
 
     def glim_number2geol_mapping(self, value: int):
         return self.glim_mapping_dataframe[self.glim_mapping_dataframe['Value'] == value]['Litho'].values[0][:2]
@@ -97,14 +86,24 @@ class Glim():
     def short2long_name(self, short_name: str):
         return self.short2long_dataframe[self.short2long_dataframe['short'] == short_name]['long'].values[0]
 
-    def extract_basin_attributes_glim_all(self, shape_file: str) -> dict:
-        res = extract_raster(raster=self.glim_raster_tif, shape_file=shape_file, output_file=None)
-        res = res[res < 1000].flatten()
-        res_list = res[res != self.nan_value].flatten().tolist()
-
-        res_str = [self.glim_number2geol_mapping(number) for number in res_list]
+    def geol_class_counts(self, shape_file: str):
+        '''
+        Pixel count of every class of the basin, from one extraction shared by extract_basin_attributes_glim and
+        extract_basin_attributes_glim_all.
+
+        :return: (geol classes, counts), classes without pixels left out
+        '''
+        if shape_file not in self.counts:
+            res = self.engine.values(self.glim_raster_tif, shape_file)
+            res = res[(res < 1000) & (res != self.nan_value)].astype(np.int64)
+            # negative values would index the lookup from its end
+            codes = self.lookup[res[(res >= 0) & (res < len(self.lookup))]]
+            count = np.bincount(codes[codes >= 0], minlength=len(self.geol_classes))
+            self.counts[shape_file] = (self.geol_classes[count > 0], count[count > 0])
+        return self.counts[shape_file]
 
-        geol_class, count = np.unique(res_str, return_counts=True)
+    def extract_basin_attributes_glim_all(self, shape_file: str) -> dict:
+        geol_class, count = self.geol_class_counts(shape_file)
 
         res = {}
         for name, c in zip(geol_class, count):
@@ -113,13 +112,7 @@ class Glim():
         return res
 
     def extract_basin_attributes_glim(self, shape_file: str) -> dict:
-        res = extract_raster(raster=self.glim_raster_tif, shape_file=shape_file, output_file=None)
-        res = res[res < 1000].flatten()
-        res_list = res[res != self.nan_value].flatten().tolist()
-
-        res_str = [self.glim_number2geol_mapping(number) for number in res_list]
-
-        geol_class, count = np.unique(res_str, return_counts=True)
+        geol_class, count = self.geol_class_counts(shape_file)
 
         geol_class_rank = [x for _, x in sorted(zip(count, geol_class), reverse=True)]
         if len(geol_class_rank) == 0:
@@ -152,6 +145,16 @@ class Glim():
                 'carb_rocks_frac: ': carb_rocks_frac}
 
 
+def init_worker(specs: dict, mask_cache_dir: str, *args, **kwargs):
+    ''' args are those of Glim '''
+    global worker_glimer
+    worker_glimer = Glim(*args, mask_cache=MaskCache(mask_cache_dir), shared_rasters=attach_rasters(specs), **kwargs)
+
+
+def worker_glim_all(shape_file: str):
+    return shp_id(shape_file), worker_glimer.extract_basin_attributes_glim_all(shape_file=shape_file)
+
+
 if __name__ == '__main__':
     print('-> calculating lithology')
 
@@ -159,12 +162,12 @@ if __name__ == '__main__':
     glim_cate_number_mapping_file = "data/glim_cate_number_mapping.csv"
     short2long_name_txt = "data/glim_name_short_long.txt"
     nan_value = 65535
+    num_workers = os.cpu_count()
 
-    glimer = Glim(glim_raster_tif=glim_raster_tif, glim_cate_number_mapping_file=glim_cate_number_mapping_file,
-                  short2long_name_txt=short2long_name_txt, nan_value=nan_value)
-
-    res = {}
-    for shape_file in tqdm([file for file in absolute_file_paths('./shapefiles') if file.endswith('.shp')]):
-        res[shp_id(shape_file)] = glimer.extract_basin_attributes_glim_all(shape_file=shape_file)
+    shps = [file for file in absolute_file_paths('./shapefiles') if file.endswith('.shp')]
+    glim_raster_tif = clipped_raster(glim_raster_tif, shps)
+    init_args = ('./cache/masks', glim_raster_tif, glim_cate_number_mapping_file, short2long_name_txt, nan_value)
+    res = dict(map_basins(worker_glim_all, shps, init_worker, init_args, num_workers, tif_files=[glim_raster_tif],
+                          shape_files=shps))
     res = pd.DataFrame(res).T.reset_index().rename(columns={'index': 'basin_id'})
     res.to_excel('output/glim.xlsx', index=None)
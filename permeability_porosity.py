@@ -4,6 +4,12 @@ from tqdm import tqdm
 
 from utils import *
 
+try:
+    from shapely.validation import make_valid
+except ImportError:  # shapely < 1.8
+    def make_valid(geometry):
+        return geometry.buffer(0)
+
 '''
 Calculate catchment aggregated permeability and porosity based on GLHYMPS.
 
@@ -14,39 +20,147 @@ Processed: https://zenodo.org/record/5137288/files/9_code_data.zip?download=1
 Reference: 
 Gleeson, Tom, 2018, "GLobal HYdrogeology MaPS (GLHYMPS) of permeability and porosity", https://doi.org/10.5683/SP2/DLGXYO, Scholars Portal Dataverse, V1
 
+If the source polygons are available (./data/GLHYMPS/GLHYMPS.shp), basins are overlaid with the polygons directly
+(see GLHYMPSPolygons) instead of masking the processed rasters.
+
 '''
 
 
 class GLHYMPS():
 
-    def __init__(self, permeabilit_no_permafrost_raster_tif: str, porosity_raster_tif: str, nan_value=65535):
+    def __init__(self, permeabilit_no_permafrost_raster_tif: str, porosity_raster_tif: str, nan_value=65535,
+                 mask_cache: MaskCache = None, shared_rasters=None):
         self.permeabilit_no_permafrost_raster_tif = permeabilit_no_permafrost_raster_tif
         self.porosity_raster_tif = porosity_raster_tif
         self.nan_value = nan_value
+        self.engine = ZonalEngine(mask_cache, shared_rasters=shared_rasters)
 
     def zonal_stats_glhymps(self, shape_file: str) -> dict:
-        permeability = zonal_stats_singletif(tif_file=self.permeabilit_no_permafrost_raster_tif, shape_file=shape_file,
-                                             valid_min=-self.nan_value, valid_max=self.nan_value)
-        porosity = zonal_stats_singletif(tif_file=self.porosity_raster_tif, shape_file=shape_file,
-                                         valid_min=-self.nan_value, valid_max=self.nan_value)
+        tifs = [self.permeabilit_no_permafrost_raster_tif, self.porosity_raster_tif]
+        stats = self.engine.stats_stack(tifs, shape_file, valid_ranges=[(-self.nan_value, self.nan_value)] * 2)
+        permeability = stats[self.permeabilit_no_permafrost_raster_tif]['mean']
+        porosity = stats[self.porosity_raster_tif]['mean']
 
         return {'permeability': permeability, 'porosity': porosity}
 
 
+def valid_geometry(geometry):
+    ''' geometry, repaired if invalid (e.g. self-intersecting rings), an overlay with it would raise a GEOS error '''
+    return geometry if geometry.is_valid else make_valid(geometry)
+
+
+class GLHYMPSPolygons():
+    '''
+    Area-weighted permeability and porosity of a basin by exact overlay of the GLHYMPS polygons.
+
+    The polygons (only those within bounds, if given) are loaded once into an STRtree. Every basin is projected to the
+    CRS of GLHYMPS and intersected with the polygons the tree returns; polygons fully inside the basin are taken
+    whole. Areas are measured in the CRS of the GLHYMPS shapefile, which is cylindrical equal area. Permeability is
+    stored as log10 in GLHYMPS, so its area-weighted mean is a mean in log space. The values keep the units of the
+    fields, as in the processed rasters.
+    '''
+
+    def __init__(self, glhymps_shp: str, permeability_field='logK_Ferr_', porosity_field='Porosity_x', bounds=None,
+                 bounds_crs='EPSG:4326'):
+        '''
+        :param bounds: (left, bottom, right, top) in bounds_crs, e.g. shapefiles_bounds of the basins
+        '''
+        with fiona.open(glhymps_shp, "r") as src:
+            self.crs = src.crs_wkt
+            if bounds is not None:
+                features = [feature for _, feature in src.items(
+                    bbox=rasterio.warp.transform_bounds(bounds_crs, self.crs, *bounds))]
+            else:
+                features = list(src)
+        self.geometries = [valid_geometry(shapely.geometry.shape(feature['geometry'])) for feature in features]
+        self.values = np.array([[feature['properties'][permeability_field], feature['properties'][porosity_field]]
+                                for feature in features], dtype=np.float64).reshape(-1, 2)
+        self.tree = shapely.strtree.STRtree(self.geometries)
+        # shapely < 2 returns geometries from query instead of their indices
+        self.index = {id(geometry): i for i, geometry in enumerate(self.geometries)}
+
+    def candidates(self, geometry) -> list:
+        hits = self.tree.query(geometry)
+        return [i if isinstance(i, (int, np.integer)) else self.index[id(i)] for i in hits]
+
+    def basin_geometry(self, shape_file: str):
+        with fiona.open(shape_file, "r") as shapefile:
+            crs = shapefile.crs_wkt or 'EPSG:4326'
+            shapes = [valid_geometry(shapely.geometry.shape(rasterio.warp.transform_geom(crs, self.crs,
+                                                                                         feature['geometry'])))
+                      for feature in shapefile]
+        return valid_geometry(shapely.ops.unary_union(shapes))
+
+    def zonal_stats_glhymps(self, shape_file: str) -> dict:
+        basin = self.basin_geometry(shape_file)
+        prepared = shapely.prepared.prep(basin)
+        index = []
+        areas = []
+        for i in self.candidates(basin):
+            geometry = self.geometries[i]
+            if prepared.contains(geometry):
+                area = geometry.area
+            elif prepared.intersects(geometry):
+                area = geometry.intersection(basin).area
+            else:
+                continue
+            index.append(i)
+            areas.append(area)
+        values = self.values[index]
+        areas = np.array(areas)
+        res = []
+        for column in range(values.shape[1]):
+            valid = ~np.isnan(values[:, column]) & (areas > 0)
+            if valid.sum() == 0:
+                res.append(np.nan)
+            else:
+                res.append(np.sum(values[valid, column] * areas[valid]) / np.sum(areas[valid]))
+
+        return {'permeability': res[0], 'porosity': res[1]}
+
+
 def shp_id(shpfile: str):
     return re.findall(r'[\d]+', shpfile)[-1]
 
 
+def init_worker(specs: dict, mask_cache_dir: str, *args, **kwargs):
+    ''' args are those of GLHYMPS '''
+    global worker_glhympser
+    worker_glhympser = GLHYMPS(*args, mask_cache=MaskCache(mask_cache_dir), shared_rasters=attach_rasters(specs),
+                               **kwargs)
+
+
+def init_worker_polygons(glhympser: GLHYMPSPolygons):
+    '''
+    glhympser is built once in the parent process: forked workers inherit its polygons and STRtree instead of each
+    reading GLHYMPS and building its own
+    '''
+    global worker_glhympser
+    worker_glhympser = glhympser
+
+
+def worker_zonal_stats_glhymps(shape_file: str):
+    return shp_id(shape_file), worker_glhympser.zonal_stats_glhymps(shape_file=shape_file)
+
+
 if __name__ == '__main__':
     print('-> calculating permeability and porosity')
     permeability_no_permafrost_raster_tif = r"./data/processed_permeability.tif"
     porosity_raster_tif = r'./data/processed_porosity.tif'
+    glhymps_shp = r'./data/GLHYMPS/GLHYMPS.shp'
     nan_value = 65535
-
-    glhympser = GLHYMPS(permeability_no_permafrost_raster_tif, porosity_raster_tif, nan_value=nan_value)
-
-    res = {}
-    for shape_file in tqdm([file for file in absolute_file_paths('./shapefiles') if file.endswith('.shp')]):
-        res[shp_id(shape_file)] = glhympser.zonal_stats_glhymps(shape_file=shape_file)
+    num_workers = os.cpu_count()
+
+    shps = [file for file in absolute_file_paths('./shapefiles') if file.endswith('.shp')]
+    if os.path.isfile(glhymps_shp):
+        # exact area-weighted overlay with the source polygons
+        glhympser = GLHYMPSPolygons(glhymps_shp, bounds=shapefiles_bounds(shps))
+        res = dict(map_basins(worker_zonal_stats_glhymps, shps, init_worker_polygons, (glhympser,), num_workers))
+    else:
+        bounds = shapefiles_bounds(shps)
+        tifs = [clipped_raster(tif, bounds=bounds)
+                for tif in [permeability_no_permafrost_raster_tif, porosity_raster_tif]]
+        res = dict(map_basins(worker_zonal_stats_glhymps, shps, init_worker, ('./cache/masks', *tifs, nan_value),
+                              num_workers, tif_files=tifs, shape_files=shps))
     res = pd.DataFrame(res).T.reset_index().rename(columns={'index': 'basin_id'})
     res.to_excel('./output/glhymps.xlsx', index=None)
@@ -5,6 +5,7 @@ import pandas as pd
 from tqdm import tqdm
 
 from utils import *
+from land_cover import igbp_class_counts, igbp_classes, basin_class_counts
 
 '''
 Calculate effective rooting depth distribution based on the IGBP land cover classification map.
@@ -75,24 +76,39 @@ def modis_land_cover_igbp_name2number(name: str):
 class DepthMapper():
     def __init__(self, root_depth_file: str):
         self.land_root_depth = pd.read_table(root_depth_file, sep=',')
+        # depth of every IGBP value 0..17, value i mapped as modis_land_cover_igbp_number2name(i)
+        depth = self.land_root_depth.set_index('land')
+        names = [modis_land_cover_igbp_number2name(index) for index in range(igbp_classes)]
+        self.depth50 = depth.loc[names, '50'].values.astype(np.float64)
+        self.depth99 = depth.loc[names, '99'].values.astype(np.float64)
 
     def igbp2depth50(self, igbp_index: int):
-        name = modis_land_cover_igbp_number2name(igbp_index)
-        return self.land_root_depth[self.land_root_depth['land'] == name]['50'].values[0]
+        return self.depth50[igbp_index]
 
     def igbp2depth99(self, igbp_index: int):
-        name = modis_land_cover_igbp_number2name(igbp_index)
-        return self.land_root_depth[self.land_root_depth['land'] == name]['99'].values[0]
-
-
-def root_depth_50_99_stats(shape_file: str, igbp_tif: str, depth_mapper: DepthMapper):
-    res = extract_raster_by_shape_file(raster=igbp_tif, shape_file=shape_file, output_file=None)
-    res = res[res != -9999]
-    res_list = res[res < 17].flatten().tolist()
-    print('-> mapping igbp classification to effective rooting depth for each pixel')
-    depth50 = [depth_mapper.igbp2depth50(index) for index in tqdm(res_list, position=0, leave=True, file=sys.stdout)]
-    depth99 = [depth_mapper.igbp2depth99(index) for index in tqdm(res_list, position=0, leave=True, file=sys.stdout)]
-    return {'root_depth_50': np.mean(depth50), 'root_depth_99': np.mean(depth99)}
+        return self.depth99[igbp_index]
+
+    def mean_depth(self, counts: np.array) -> dict:
+        '''
+        Basin mean rooting depth from its IGBP class counts (see igbp_class_counts): the dot product of the
+        normalised counts with the per-class depths. Values below 17 are used, as before (water bodies excluded).
+        '''
+        count = counts[:17].astype(np.float64)
+        if np.sum(count) == 0:
+            return {'root_depth_50': np.nan, 'root_depth_99': np.nan}
+        weights = count / np.sum(count)
+        return {'root_depth_50': np.dot(weights, self.depth50[:17]),
+                'root_depth_99': np.dot(weights, self.depth99[:17])}
+
+
+def root_depth_50_99_stats(shape_file: str, igbp_tif: str, depth_mapper: DepthMapper, engine: ZonalEngine = None,
+                           counts=None):
+    '''
+    :param counts: IGBP class counts of the basin (see igbp_class_counts), read from igbp_tif if None
+    '''
+    if counts is None:
+        counts = igbp_class_counts(shape_file, igbp_tif, engine=engine)
+    return depth_mapper.mean_depth(counts)
 
 
 if __name__ == '__main__':
@@ -101,9 +117,13 @@ if __name__ == '__main__':
     root_depth = "./data/root_depth_calculated.txt"
     shp_dir = './shapefiles'
     out = './output/root_depth.xlsx'
-    depth_mapper = DepthMapper(root_depth)
+    num_workers = os.cpu_count()
 
-    res = {}
-    for shape_file in [file for file in absolute_file_paths(shp_dir) if file.endswith('.shp')]:
-        res[shp_id(shape_file)] = root_depth_50_99_stats(shape_file, igbp_tif, depth_mapper)
+    shps = [file for file in absolute_file_paths(shp_dir) if file.endswith('.shp')]
+    igbp_tif = clipped_raster(igbp_tif, shps)
+    # class counts left by land_cover.py are reused, only basins it has not counted are read
+    counts = basin_class_counts(shps, igbp_tif, num_workers)
+    depth_mapper = DepthMapper(root_depth)
+    res = {shp_id(shape_file): root_depth_50_99_stats(shape_file, igbp_tif, depth_mapper, counts=count)
+           for shape_file, count in counts.items()}
     pd.DataFrame(res).T.reset_index().rename(columns={'index': 'basin_id'}).to_excel(out)
@@ -1,12 +1,13 @@
 import subprocess
+from multiprocessing import Pool
 
 import numpy as np
 import netCDF4
 from osgeo import gdal, osr
-import cv2
 import xarray
 
 from utils import *
+from catalog import DataCatalog, catalog_file
 
 '''
 Calculate catchment aggregated soil characteristics.
@@ -184,28 +185,72 @@ def tif_from_nc(ncfile: str, variable_key: str, output_file: str):
     ds = None
 
 
-def binary2tif(file, out_path):
+def binary2tif(file, out_path, shape=(21600, 43200), factor=10, block_rows=480, nodata=-9999):
     '''
+    Convert a float64 binary layer of Dai et al. (north-up, 1/120 degree, global) to a tiled float32 GeoTIFF downscaled
+    factor times. The binary is memory-mapped and streamed in strips of block_rows rows, so memory stays in the
+    hundreds of MB instead of the whole layer. The minimum of the layer is its fill value: every output pixel is the
+    mean of the valid pixels of its factor x factor block, nodata if there are none.
+
     :param file: /path/to/binary
     :param out_path: out/tif/path
     '''
-    data = np.fromfile(file, dtype=np.float64).reshape((21600, 43200))
-    data[data == data.min()] = -9999
-    tif_from_array(cv2.flip(np.rot90(cv2.resize(data, (43200 // 10, 21600 // 10)), 2), 1), out_path)
+    data = np.memmap(file, dtype=np.float64, mode='r', shape=shape)
+    height, width = shape[0] // factor, shape[1] // factor
+    block_rows = max(factor, block_rows // factor * factor)
+    fill = min(data[row:row + block_rows].min() for row in range(0, height * factor, block_rows))
+
+    profile = {
+        'driver': 'GTiff',
+        'dtype': 'float32',
+        'count': 1,
+        'width': width,
+        'height': height,
+        'crs': 'EPSG:4326',
+        'transform': Affine(360. / width, 0, -180, 0, -180. / height, 90),
+        'nodata': nodata,
+        'tiled': True,
+        'blockxsize': 256,
+        'blockysize': 256,
+        'compress': 'deflate',
+        'predictor': 3
+    }
+    # written aside and renamed, a partial conversion is never taken for a converted layer
+    tmp_path = out_path + '.tmp'
+    with rasterio.open(tmp_path, 'w', **profile) as dst:
+        for row in range(0, height * factor, block_rows):
+            strip = np.array(data[row:min(row + block_rows, height * factor), :width * factor])
+            rows = strip.shape[0] // factor
+            valid = strip != fill
+            strip[~valid] = 0
+            total = strip.reshape(rows, factor, width, factor).sum(axis=(1, 3))
+            count = valid.reshape(rows, factor, width, factor).sum(axis=(1, 3))
+            out = np.full((rows, width), nodata, dtype=np.float32)
+            out[count > 0] = total[count > 0] / count[count > 0]
+            dst.write(out, 1, window=rasterio.windows.Window(0, row // factor, width, rows))
+    del data
+    os.replace(tmp_path, out_path)
+
+
+def worker_binary2tif(file: str):
+    binary2tif(file, file + '.tif')
 
 
 if __name__ == '__main__':
     print('-> soil')
+    # basin-major (default): one window per basin and layer, large basins read a decimated overview level.
+    # raster-major: every layer is streamed once at full resolution for all basins at the same time (see
+    # ZonalEngine.stats_raster_major), faster when many basins cover the region densely, memory grows with the
+    # number of basin pixels
+    raster_major = False
 
     # binary
     print('-> binary to tif')
     files = absolute_file_paths('./data/soil_source_data/binary')
-    for file in tqdm(files):
-        if '.' in file:
-            continue
-        if file + '.tif' in files:
-            continue
-        binary2tif(file, file + '.tif')
+    tasks = [file for file in files if '.' not in os.path.basename(file) and file + '.tif' not in files]
+    # layers are streamed strip by strip, several of them convert in parallel
+    with Pool(min(len(tasks), os.cpu_count()) or 1) as pool:
+        list(tqdm(pool.imap_unordered(worker_binary2tif, tasks), total=len(tasks)))
 
     # netcdf
     print('-> nc to tif')
@@ -230,18 +275,37 @@ if __name__ == '__main__':
     # zonal stats
     print('-> zonal stats')
     res = {}
-    files = [x for x in absolute_file_paths('./data/soil_source_data') if x.endswith('.tif')]
+    # refreshed, the tifs converted above are new
+    with DataCatalog(catalog_file) as catalog:
+        files = catalog.files('soil', './data/soil_source_data', refresh=True, ext='tif')
     shps = [x for x in absolute_file_paths('./shapefiles') if x.endswith('.shp')]
+    bounds = shapefiles_bounds(shps)
+    files = [clipped_raster(file, bounds=bounds) for file in files]
+    var_names = [os.path.basename(file).split('.')[0].replace('_downscaled', '') for file in files]
+    valid_ranges = [(0, None)] * len(files)
+    # overviews instead of permanently downscaled TIFs: large basins read a decimated level, small ones full resolution
     for file in files:
-        try:
-            for shp in shps:
-                if not shp_id(shp) in res:
-                    res[shp_id(shp)] = {}
-                var_name = os.path.basename(file).split('.')[0].replace('_downscaled', '')
-                res[shp_id(shp)][var_name] = zonal_stats_singletif(file, shp, valid_min=0, valid_max=None)
-        except Exception as e:
-            print(e)
-            continue
+        build_overviews(file)
+    with ZonalEngine(MaskCache('./cache/masks'), pixel_budget=4096 * 4096) as engine:
+        if raster_major:
+            for file, var_name in tqdm(list(zip(files, var_names))):
+                try:
+                    stats = engine.stats_raster_major(file, shps, valid_min=0, valid_max=None)
+                except Exception as e:
+                    print(e)
+                    continue
+                for shp in shps:
+                    res.setdefault(shp_id(shp), {'decimation': 1})[var_name] = stats[shp]['mean']
+        else:
+            for shp in tqdm(shps):
+                try:
+                    # all soil layers of the basin at once, one mask per grid and one window per layer
+                    stats = engine.stats_stack(files, shp, valid_ranges=valid_ranges)
+                    res[shp_id(shp)] = {var_name: stats[file]['mean'] for file, var_name in zip(files, var_names)}
+                    res[shp_id(shp)]['decimation'] = max(stats[file]['decimation'] for file in files)
+                except Exception as e:
+                    print(e)
+                    continue
     res = pd.DataFrame(res).T
     res.columns = [x.lower().replace(' ', '_') for x in res.columns]
     res.reset_index().rename(columns={'index': 'basin_id'}).to_excel('./output/soil.xlsx')
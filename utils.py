@@ -1,48 +1,109 @@
 import time
 import subprocess
 import os
+import math
 import re
 import datetime
+import hashlib
+import contextlib
+import shutil
+import tempfile
+import weakref
+from collections import OrderedDict
+from multiprocessing import Pool, shared_memory
 
 import numpy as np
 import pandas as pd
 import pickle
-from osgeo import gdal, osr
+from osgeo import gdal, osr, gdal_array
 from tqdm import tqdm
 import fiona
 import netCDF4
 from netCDF4 import Dataset
 import geopandas as gpd
+import shapely.geometry
+import shapely.ops
+import shapely.prepared
+import shapely.strtree
 import rasterio
 import rasterio.mask
+import rasterio.windows
+import rasterio.features
+import rasterio.shutil
+from rasterio.crs import CRS
 from rasterio.merge import merge
+from rasterio.vrt import WarpedVRT
+from rasterio.io import MemoryFile
+from rasterio.transform import Affine
 from rasterio.warp import calculate_default_transform, reproject, Resampling
 
 
+def write_geotif(array: np.array, geo_transform: list, output_file: str, dtype=None, scale=None, offset=0.,
+                 overviews=None, block_rows=256):
+    '''
+    Write a 2d array to a tiled, DEFLATE compressed GeoTIFF in WGS84. Band statistics (-9999 and nan excluded) are
+    accumulated while the array is written strip by strip, instead of separate full passes.
+
+    :param geo_transform: GDAL geotransform
+    :param dtype: None to keep the dtype of array, 'float32', or 'int16' to store round((array - offset) / scale)
+                  with scale and offset set on the band (-9999 and nan become the nodata value -32768); scale is
+                  only valid for int16, other dtypes store the values as they are
+    :param overviews: factors of internal overviews to build, e.g. [2, 4, 8]
+    :param block_rows: rows written at a time
+    '''
+    dtype = np.dtype(array.dtype if dtype is None else dtype)
+    if dtype == np.int16 and scale is None:
+        raise ValueError('scale is needed to store int16')
+    if dtype != np.int16 and scale is not None:
+        raise ValueError(f'scale is only applied to int16, not {dtype}')
+    predictor = 3 if np.issubdtype(dtype, np.floating) else 2
+    driver = gdal.GetDriverByName('GTiff')
+    ds = driver.Create(output_file, array.shape[1], array.shape[0], 1,
+                       gdal_array.NumericTypeCodeToGDALTypeCode(dtype),
+                       ['TILED=YES', 'BLOCKXSIZE=256', 'BLOCKYSIZE=256', 'COMPRESS=DEFLATE', f'PREDICTOR={predictor}'])
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    ds.SetProjection(srs.ExportToWkt())
+    ds.SetGeoTransform(list(geo_transform))
+    outband = ds.GetRasterBand(1)
+    if scale is not None:
+        outband.SetScale(scale)
+        outband.SetOffset(offset)
+    if dtype == np.int16:
+        outband.SetNoDataValue(-32768)
+    accumulator = ZonalAccumulator()
+    for row in range(0, array.shape[0], block_rows):
+        strip = array[row:row + block_rows]
+        accumulator.update(strip.ravel())
+        if dtype == np.int16:
+            invalid = np.isnan(strip) | (strip == -9999)
+            strip = np.clip(np.round((strip - offset) / scale), -32767, 32767)
+            strip[invalid] = -32768
+        outband.WriteArray(strip.astype(dtype), 0, row)
+    stats = accumulator.result()
+    if stats['count'] > 0:
+        # gdal statistics are of the stored values
+        a, b = (1. / scale, -offset / scale) if scale is not None else (1., 0.)
+        outband.SetStatistics(float(stats['min'] * a + b), float(stats['max'] * a + b),
+                              float(stats['mean'] * a + b), float(stats['std'] * abs(a)))
+    if overviews is not None:
+        ds.BuildOverviews('AVERAGE', list(overviews))
+    ds = None
+
+
 def geotif_from_array(array: np.array, lat_start: float, lat_end: float, lon_start: float, lon_end: float,
-                      degree: float, output_file: str):
+                      degree: float, output_file: str, dtype='float32', scale=None, overviews=None):
+    ''' :param dtype, scale, overviews: see write_geotif, float32 by default as before '''
     nx, ny = array.shape
     mag_grid = np.reshape(array, (nx, ny), order='F')  # !!!
-    mag_grid = np.float64(mag_grid)
     lats = np.linspace(start=lat_start, stop=lat_end, num=mag_grid.shape[0])
     lons = np.linspace(start=lon_start, stop=lon_end, num=mag_grid.shape[1])
     assert len(lats) == mag_grid.shape[0]
     assert len(lons) == mag_grid.shape[1]
     xres = lons[1] - lons[0]
     yres = lats[1] - lats[0]
-    ysize = len(lats)
-    xsize = len(lons)
-    driver = gdal.GetDriverByName('GTiff')
-    ds = driver.Create(output_file, xsize, ysize, 1, gdal.GDT_Float32)
-    srs = osr.SpatialReference()
-    srs.ImportFromEPSG(4326)
-    ds.SetProjection(srs.ExportToWkt())
     gt = [lon_start, xres, 0, lat_start, 0, yres]
-    ds.SetGeoTransform(gt)
-    outband = ds.GetRasterBand(1)
-    outband.SetStatistics(np.min(mag_grid), np.max(mag_grid), np.average(mag_grid), np.std(mag_grid))
-    outband.WriteArray(mag_grid)
-    ds = None
+    write_geotif(mag_grid, gt, output_file, dtype=dtype, scale=scale, overviews=overviews)
 
 
 def shp_id(shpfile: str):
@@ -58,42 +119,159 @@ def absolute_file_paths(directory):
     return list(nest(directory))
 
 
-def reproject_tif(src_tif: str, out_tif: str, out_crc='EPSG:4326'):
+def reproject_tif(src_tif: str, out_tif: str, out_crc='EPSG:4326', resampling=Resampling.nearest, num_threads=1,
+                  max_block_pixels=2 ** 24):
+    '''
+    Reproject src_tif to out_crc. The destination is tiled and written block by block, each block holding at most
+    max_block_pixels pixels of all bands and warped with num_threads threads, so memory does not grow with the
+    image. Use warped_tif instead if only part of the reprojected raster is needed.
+    '''
     with rasterio.open(src_tif) as src:
+        if src.crs == CRS.from_user_input(out_crc):
+            # already in the target crs, resampling onto the same grid is a no-op
+            rasterio.shutil.copy(src, out_tif, driver='GTiff')
+            return
         transform, width, height = calculate_default_transform(
             src.crs, out_crc, src.width, src.height, *src.bounds)
         kwargs = src.meta.copy()
         kwargs.update({
+            'driver': 'GTiff',
             'crs': out_crc,
             'transform': transform,
             'width': width,
-            'height': height
+            'height': height,
+            'tiled': True,
+            'blockxsize': 256,
+            'blockysize': 256
         })
 
+        # destination blocks made of whole 256 x 256 tiles
+        cols = min(width, max(256, max_block_pixels // (256 * src.count) // 256 * 256))
+        rows = max(256, max_block_pixels // (cols * src.count) // 256 * 256)
+        bands = list(range(1, src.count + 1))
         with rasterio.open(out_tif, 'w', **kwargs) as dst:
-            for i in range(1, src.count + 1):
-                reproject(
-                    source=rasterio.band(src, i),
-                    destination=rasterio.band(dst, i),
-                    src_transform=src.transform,
-                    src_crs=src.crs,
-                    dst_transform=transform,
-                    dst_crs=out_crc,
-                    resampling=Resampling.nearest)
-
-
-def merge_tifs(tif_files: list, outfile: str):
-    src_files_to_mosaic = []
-    for fp in tif_files:
-        src = rasterio.open(fp)
-        src_files_to_mosaic.append(src)
-    mosaic, out_trans = merge(src_files_to_mosaic)
-    out_meta = src.meta.copy()
+            for row in range(0, height, rows):
+                for col in range(0, width, cols):
+                    window = rasterio.windows.Window(col, row, min(cols, width - col), min(rows, height - row))
+                    block = np.full((src.count, int(window.height), int(window.width)),
+                                    src.nodata if src.nodata is not None else 0, dtype=src.dtypes[0])
+                    reproject(
+                        source=rasterio.band(src, bands),
+                        destination=block,
+                        src_transform=src.transform,
+                        src_crs=src.crs,
+                        src_nodata=src.nodata,
+                        dst_transform=dst.window_transform(window),
+                        dst_crs=out_crc,
+                        dst_nodata=src.nodata,
+                        resampling=resampling,
+                        num_threads=num_threads)
+                    dst.write(block, window=window)
+
+
+@contextlib.contextmanager
+def warped_tif(src_tif: str, out_crc='EPSG:4326', resampling=Resampling.nearest, num_threads=1):
+    '''
+    Virtual reprojection of src_tif: a WarpedVRT in out_crs that warps only the windows actually read.
+
+    > with warped_tif(tif) as src:
+    >     array = src.read(1, window=window)
+    '''
+    with rasterio.open(src_tif) as src:
+        if src.crs == CRS.from_user_input(out_crc):
+            yield src
+            return
+        with WarpedVRT(src, crs=out_crc, resampling=resampling, warp_extras={'NUM_THREADS': num_threads}) as vrt:
+            yield vrt
+
+
+class Scratch():
+    '''
+    Private scratch space for intermediate files, one per worker: a folder named after the process in tmpfs
+    (memory_dir) while its content stays under memory_limit bytes, and a folder on disk (under disk_dir, the system
+    temp dir by default) beyond that or if there is no tmpfs. Everything is removed on close, when leaving the with
+    block (also on error), or at the latest when the interpreter exits.
+
+    > with Scratch('lai') as scratch:
+    >     tif = scratch.path('merged.tif')
+    '''
+
+    def __init__(self, prefix='scratch', memory_limit=2 ** 30, memory_dir='/dev/shm', disk_dir=None):
+        self.prefix = f'{prefix}_{os.getpid()}_'
+        self.memory_limit = memory_limit
+        self.disk_dir = disk_dir
+        self.folders = []
+        self.memory = None
+        self.disk = None
+        if memory_dir is not None and os.path.isdir(memory_dir) and os.access(memory_dir, os.W_OK):
+            self.memory = tempfile.mkdtemp(prefix=self.prefix, dir=memory_dir)
+            self.folders.append(self.memory)
+        self.finalizer = weakref.finalize(self, Scratch.remove, self.folders)
+
+    @staticmethod
+    def remove(folders: list):
+        for folder in folders:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    def memory_used(self) -> int:
+        return sum(os.path.getsize(os.path.join(path, f)) for path, _, files in os.walk(self.memory) for f in files)
+
+    def folder(self, name='', size_hint=0) -> str:
+        '''
+        :param name: sub folder name, '' for the top folder
+        :param size_hint: expected size in bytes of what will be written, decides between memory and disk
+        :return: path of the (created) folder
+        '''
+        if self.memory is not None and self.memory_used() + size_hint <= self.memory_limit and \
+                shutil.disk_usage(self.memory).free > size_hint:
+            root = self.memory
+        else:
+            if self.disk is None:
+                self.disk = tempfile.mkdtemp(prefix=self.prefix, dir=self.disk_dir)
+                self.folders.append(self.disk)
+            root = self.disk
+        folder = os.path.join(root, name)
+        os.makedirs(folder, exist_ok=True)
+        return folder
+
+    def path(self, name: str, size_hint=0) -> str:
+        ''' :return: path of a file in the scratch space, see folder '''
+        return os.path.join(self.folder(os.path.dirname(name), size_hint), os.path.basename(name))
+
+    def clear(self):
+        ''' remove all intermediate files, the scratch space stays usable '''
+        for folder in self.folders:
+            shutil.rmtree(folder, ignore_errors=True)
+            os.makedirs(folder, exist_ok=True)
+
+    def close(self):
+        self.finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def merge_tifs(tif_files: list, outfile: str, warp_crs=None, num_threads=1):
+    '''
+    :param warp_crs: if given, the tifs are reprojected to warp_crs on the fly (see warped_tif) while merging,
+                     instead of reprojecting every tif to a file first
+    '''
+    with contextlib.ExitStack() as stack:
+        if warp_crs is None:
+            src_files_to_mosaic = [stack.enter_context(rasterio.open(fp)) for fp in tif_files]
+        else:
+            src_files_to_mosaic = [stack.enter_context(warped_tif(fp, warp_crs, num_threads=num_threads))
+                                   for fp in tif_files]
+        mosaic, out_trans = merge(src_files_to_mosaic)
+        out_meta = src_files_to_mosaic[-1].meta.copy()
     out_meta.update({"driver": "GTiff",
                      "height": mosaic.shape[1],
                      "width": mosaic.shape[2],
                      "transform": out_trans,
-                     "crs": "EPSG:4326"})
+                     "crs": warp_crs if warp_crs is not None else "EPSG:4326"})
     with rasterio.open(outfile, "w", **out_meta) as dest:
         dest.write(mosaic)
 
@@ -116,35 +294,710 @@ def extract_raster_by_shape_file(raster: str, shape_file: str, output_file=None)
         return out_image
 
 
-def gdal_downsample_tif(tif_file: str, working_dir: str, percent: int):
+resampling_methods = {'average': Resampling.average, 'mode': Resampling.mode, 'nearest': Resampling.nearest}
+
+
+def downsample_raster(src_tif: str, out_tif=None, percent=50, resampling='nearest'):
     '''
+    Downsample a raster in process, reading it decimated by GDAL. The source is left untouched and nothing depends
+    on the working directory, so it is safe to call from many workers at once.
 
-    :param tif_file: tif file path
-    :param working_dir: data processing root dir
-    :param percent: downsample percent
-    :return: downsampled tif
+    :param src_tif: tif file path
+    :param out_tif: output tif path, None to keep the result in memory
+    :param percent: output size in percent of the source size
+    :param resampling: 'average' for continuous values, 'mode' for classes, 'nearest' to keep the source values
+    :return: out_tif, or a rasterio MemoryFile holding the downsampled GeoTIFF (open it with .open())
     '''
-    cwd = os.getcwd()
-    os.chdir(working_dir)
-    ori_name = os.path.basename(tif_file)
-    new_name = os.path.basename(ori_name)[:-4] + '_downscaled.tif'
-    os.rename(tif_file, new_name)
-    command = f'gdal_translate -outsize {percent}% GTiff {new_name} {ori_name}'
-    process = subprocess.Popen(command.split(), stdout=subprocess.PIPE)
-    output, error = process.communicate()
-    os.remove(ori_name)
-    os.chdir(cwd)
+    with rasterio.open(src_tif) as src:
+        width = max(1, int(round(src.width * percent / 100)))
+        height = max(1, int(round(src.height * percent / 100)))
+        array = src.read(out_shape=(src.count, height, width), resampling=resampling_methods[resampling])
+        profile = src.profile.copy()
+        profile.update({
+            'driver': 'GTiff',
+            'width': width,
+            'height': height,
+            'transform': src.transform * Affine.scale(src.width / width, src.height / height)
+        })
+        for key in ['blockxsize', 'blockysize', 'tiled']:
+            profile.pop(key, None)
+    if out_tif is None:
+        memfile = MemoryFile()
+        with memfile.open(**profile) as dst:
+            dst.write(array)
+        return memfile
+    with rasterio.open(out_tif, 'w', **profile) as dst:
+        dst.write(array)
+    return out_tif
 
 
-def zonal_stats_singletif(tif_file: str, shape_file: str, valid_min=None, valid_max=None):
-    res = extract_raster_by_shape_file(tif_file, shape_file).flatten()
+def valid_values(res: np.array, valid_min=None, valid_max=None):
+    ''' drop -9999, nan and values outside (valid_min, valid_max) '''
     res = res[res != -9999]
     res = res[~np.isnan(res)]
     if valid_min is not None:
         res = res[res > valid_min]
     if valid_max is not None:
         res = res[res < valid_max]
+    return res
+
+
+def summary_stats(res: np.array) -> dict:
+    if len(res) > 0:
+        return {'count': len(res), 'mean': np.mean(res), 'min': np.min(res), 'max': np.max(res), 'std': np.std(res)}
+    else:
+        return {'count': 0, 'mean': np.nan, 'min': np.nan, 'max': np.nan, 'std': np.nan}
+
+
+class ZonalAccumulator():
+    '''
+    Incremental zonal statistics: values are fed block by block with update and only running sums are kept, so
+    memory does not grow with the number of pixels. result gives the same dict as summary_stats, or the class
+    histogram if classes is given.
+    '''
+
+    def __init__(self, valid_min=None, valid_max=None, classes=None):
+        self.valid_min = valid_min
+        self.valid_max = valid_max
+        self.classes = classes
+        self.count = 0
+        self.total = 0.
+        self.total_sq = 0.
+        self.min = np.inf
+        self.max = -np.inf
+        self.counts = np.zeros(classes, dtype=np.int64) if classes is not None else None
+
+    def update(self, values: np.array):
+        values = valid_values(values, self.valid_min, self.valid_max)
+        if len(values) == 0:
+            return
+        if self.counts is not None:
+            values = values[(values >= 0) & (values < self.classes)].astype(np.int64)
+            self.counts += np.bincount(values, minlength=self.classes)
+            return
+        self.count += len(values)
+        self.total += np.sum(values, dtype=np.float64)
+        self.total_sq += np.sum(np.square(values, dtype=np.float64))
+        self.min = min(self.min, np.min(values))
+        self.max = max(self.max, np.max(values))
+
+    def result(self) -> dict:
+        if self.counts is not None:
+            return {'counts': self.counts}
+        if self.count == 0:
+            return summary_stats(np.array([]))
+        mean = self.total / self.count
+        return {'count': self.count, 'mean': mean, 'min': self.min, 'max': self.max,
+                'std': np.sqrt(max(self.total_sq / self.count - mean ** 2, 0))}
+
+
+def zonal_stats_singletif(tif_file: str, shape_file: str, valid_min=None, valid_max=None):
+    res = valid_values(extract_raster_by_shape_file(tif_file, shape_file).flatten(), valid_min, valid_max)
     if len(res) > 0:
         return np.mean(res)
     else:
         return np.nan
+
+
+def bounds_window(src, bounds: tuple, halo=0):
+    '''
+    :param src: opened rasterio dataset
+    :param bounds: (left, bottom, right, top) in the crs of src
+    :param halo: number of extra pixels on each side
+    :return: window of bounds snapped outwards to the grid of src
+    '''
+    window = rasterio.windows.from_bounds(*bounds, transform=src.transform)
+    col_off = math.floor(window.col_off) - halo
+    row_off = math.floor(window.row_off) - halo
+    width = math.ceil(window.col_off + window.width) - math.floor(window.col_off) + 2 * halo
+    height = math.ceil(window.row_off + window.height) - math.floor(window.row_off) + 2 * halo
+    return rasterio.windows.Window(col_off, row_off, width, height)
+
+
+def read_window(src, window, band=1, fill_value=None) -> np.array:
+    '''
+    Read a window that may extend past the edges of src, the pixels outside are set to fill_value (the nodata of src,
+    or 0, if None). Same as a boundless read, which a WarpedVRT does not permit: only the part of the window inside
+    src is read and padded here.
+    '''
+    if fill_value is None:
+        fill_value = src.nodata if src.nodata is not None else 0
+    height, width = int(window.height), int(window.width)
+    array = np.full((height, width), fill_value, dtype=src.dtypes[band - 1])
+    full = rasterio.windows.Window(0, 0, src.width, src.height)
+    if not rasterio.windows.intersect(window, full):
+        return array
+    inner = window.intersection(full)
+    row, col = int(inner.row_off - window.row_off), int(inner.col_off - window.col_off)
+    array[row:row + int(inner.height), col:col + int(inner.width)] = src.read(band, window=inner)
+    return array
+
+
+def read_bounds(src, bounds: tuple, halo=0, fill_value=None):
+    '''
+    :param fill_value: value of pixels outside src
+    :return: (array, transform) of bounds_window(src, bounds, halo)
+    '''
+    window = bounds_window(src, bounds, halo=halo)
+    return read_window(src, window, fill_value=fill_value), src.window_transform(window)
+
+
+def build_overviews(tif_file: str, factors=(2, 4, 8, 16, 32), resampling='AVERAGE'):
+    '''
+    Build overviews of tif_file if it has none yet, as an external .ovr file so the source stays untouched.
+    Replaces downscaling large source TIFs permanently: ZonalEngine(pixel_budget=...) reads the overviews only
+    for basins too large for the budget. An .ovr older than tif_file (the tif was replaced since) is rebuilt.
+
+    :param resampling: 'AVERAGE' for continuous values, 'MODE' or 'NEAREST' for classes
+    '''
+    ovr_file = tif_file + '.ovr'
+    if os.path.isfile(ovr_file) and os.path.getmtime(ovr_file) < os.path.getmtime(tif_file):
+        os.remove(ovr_file)
+    with rasterio.open(tif_file) as src:
+        if len(src.overviews(1)) > 0:
+            return
+    ds = gdal.Open(tif_file, gdal.GA_ReadOnly)
+    ds.BuildOverviews(resampling, list(factors))
+    ds = None
+
+
+clip_dir = './data/clipped'
+
+
+def clipped_path(tif_file: str, folder=clip_dir) -> str:
+    ''' :return: path of the clipped copy of tif_file in folder, mirroring the path of tif_file under ./data '''
+    path = os.path.abspath(tif_file)
+    data = os.path.abspath('./data')
+    name = os.path.relpath(path, data) if path.startswith(data + os.sep) else os.path.basename(path)
+    return os.path.join(folder, name)
+
+
+def clip_raster(src_tif: str, out_tif: str, bounds: tuple, halo=2, block_rows=1024):
+    '''
+    Copy the window of bounds (snapped outwards to the grid, plus halo pixels) of src_tif to a tiled, DEFLATE
+    compressed GeoTIFF, strip by strip. The pixel grid is kept, so zonal statistics on the clip equal those on the
+    source. The source path and mtime are stored as tags (see clipped_raster), and overviews are built if the source
+    has some.
+
+    :param bounds: (left, bottom, right, top) in the crs of src_tif
+    '''
+    with rasterio.open(src_tif) as src:
+        full = rasterio.windows.Window(0, 0, src.width, src.height)
+        window = bounds_window(src, bounds, halo=halo).intersection(full)
+        width, height = int(window.width), int(window.height)
+        profile = src.profile.copy()
+        profile.update({
+            'driver': 'GTiff',
+            'width': width,
+            'height': height,
+            'transform': src.window_transform(window),
+            'tiled': True,
+            'blockxsize': 256,
+            'blockysize': 256,
+            'compress': 'deflate',
+            'predictor': 3 if np.issubdtype(np.dtype(src.dtypes[0]), np.floating) else 2,
+            'BIGTIFF': 'IF_SAFER'
+        })
+        folder = os.path.dirname(os.path.abspath(out_tif))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        # written aside and renamed, a partial clip is never picked up
+        tmp_tif = out_tif + '.tmp'
+        with rasterio.open(tmp_tif, 'w', **profile) as dst:
+            dst.scales = src.scales
+            dst.offsets = src.offsets
+            dst.update_tags(**src.tags())
+            dst.update_tags(CLIP_SOURCE=os.path.abspath(src_tif), CLIP_SOURCE_MTIME=repr(os.path.getmtime(src_tif)))
+            for row in range(0, height, block_rows):
+                rows = min(block_rows, height - row)
+                dst.write(src.read(window=rasterio.windows.Window(int(window.col_off), int(window.row_off) + row,
+                                                                  width, rows)),
+                          window=rasterio.windows.Window(0, row, width, rows))
+        overviews = len(src.overviews(1)) > 0
+    # overviews and statistics of a previous clip (possibly of other bounds) would stay attached to the new one
+    for sidecar in [out_tif + '.ovr', out_tif + '.aux.xml']:
+        if os.path.isfile(sidecar):
+            os.remove(sidecar)
+    os.replace(tmp_tif, out_tif)
+    if overviews:
+        build_overviews(out_tif)
+
+
+def clipped_raster(tif_file: str, shape_files=None, bounds=None, folder=clip_dir) -> str:
+    '''
+    The clipped copy of tif_file (see clip_raster) if there is one, it is not older than tif_file and it covers bounds
+    (or the union bbox of shape_files); tif_file otherwise.
+    '''
+    path = clipped_path(tif_file, folder)
+    if not os.path.isfile(path) or not os.path.isfile(tif_file):
+        return tif_file
+    if bounds is None:
+        bounds = shapefiles_bounds(shape_files)
+    with rasterio.open(path) as clip:
+        if clip.tags().get('CLIP_SOURCE_MTIME') != repr(os.path.getmtime(tif_file)):
+            return tif_file
+        left, bottom, right, top = clip.bounds
+    if left <= bounds[0] and bottom <= bounds[1] and right >= bounds[2] and top >= bounds[3]:
+        return path
+    return tif_file
+
+
+class MaskCache():
+    '''
+    Cache of rasterized basin masks, keyed by the raster grid (transform and shape) and a hash of the basin geometry,
+    so any raster on a known grid skips polygon rasterization. Each entry is the basin window on the grid and the
+    flat indices of the basin pixels within that window. The max_entries most recently used entries are kept in
+    memory (the same basin is looked up once per raster on its grid) and, if cache_dir is given, all of them on
+    disk as compressed npz files for later runs.
+    '''
+
+    def __init__(self, cache_dir=None, max_entries=64):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.memory = OrderedDict()
+        if cache_dir is not None and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    @staticmethod
+    def grid_key(src) -> str:
+        return repr((tuple(src.transform)[:6], src.width, src.height))
+
+    @staticmethod
+    def geometry_hash(shapes: list) -> str:
+        sha = hashlib.sha1()
+        for geometry in shapes:
+            sha.update(shapely.geometry.shape(geometry).wkb)
+        return sha.hexdigest()
+
+    def get(self, src, shapes: list, bounds: tuple, geometry_hash=None):
+        '''
+        :param src: opened rasterio dataset, defines the grid
+        :param shapes: basin geometries
+        :param bounds: basin bbox
+        :param geometry_hash: MaskCache.geometry_hash(shapes), if already known
+        :return: (window, flat pixel indices), window is None if the basin does not overlap the grid
+        '''
+        if geometry_hash is None:
+            geometry_hash = self.geometry_hash(shapes)
+        key = hashlib.sha1((self.grid_key(src) + geometry_hash).encode()).hexdigest()
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+        path = os.path.join(self.cache_dir, key + '.npz') if self.cache_dir is not None else None
+        if path is not None and os.path.isfile(path):
+            with np.load(path) as f:
+                window, index = f['window'], f['index']
+            window = rasterio.windows.Window(*window) if window[2] > 0 else None
+        else:
+            window, index = self.rasterize(src, shapes, bounds)
+            if path is not None:
+                # written aside and renamed: a killed run or another process rasterizing the same basin never leaves
+                # a truncated entry behind
+                tmp_path = f'{path[:-len(".npz")]}.{os.getpid()}.tmp.npz'
+                np.savez_compressed(tmp_path, window=np.array([0, 0, 0, 0] if window is None else
+                                                              [window.col_off, window.row_off, window.width,
+                                                               window.height]), index=index)
+                os.replace(tmp_path, path)
+        self.memory[key] = (window, index)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+        return window, index
+
+    @staticmethod
+    def rasterize(src, shapes: list, bounds: tuple):
+        window = bounds_window(src, bounds)
+        full = rasterio.windows.Window(0, 0, src.width, src.height)
+        if not rasterio.windows.intersect(window, full):
+            return None, np.array([], dtype=np.int64)
+        window = window.intersection(full)
+        mask = rasterio.features.geometry_mask(shapes, out_shape=(int(window.height), int(window.width)),
+                                               transform=src.window_transform(window), invert=True)
+        return window, np.flatnonzero(mask)
+
+
+class SharedRaster():
+    '''
+    One band of a raster (or the window of it covering bounds) decoded once into shared memory. The process that
+    creates it owns the segment; worker processes attach zero-copy, read-only NumPy views with
+    SharedRaster.attach(shared.spec), so N workers hold one copy instead of N and nothing is decompressed twice.
+
+    It implements the part of the rasterio dataset interface used by ZonalEngine (see its shared_rasters), on the grid
+    of the whole source raster: only the shared window is held, at its offset in the spec, so basin masks key on the
+    source grid (see MaskCache.grid_key) whatever bounds were shared, and pixels outside the window read as nodata.
+    '''
+
+    def __init__(self, tif_file: str, bounds=None, band=1):
+        '''
+        :param bounds: (left, bottom, right, top) to keep, None for the whole raster
+        '''
+        with rasterio.open(tif_file) as src:
+            window = rasterio.windows.Window(0, 0, src.width, src.height)
+            if bounds is not None:
+                window = bounds_window(src, bounds).intersection(window)
+            shape = (int(window.height), int(window.width))
+            dtype = src.dtypes[band - 1]
+            self.shm = shared_memory.SharedMemory(create=True, size=max(1, shape[0] * shape[1] *
+                                                                        np.dtype(dtype).itemsize))
+            array = np.ndarray(shape, dtype=dtype, buffer=self.shm.buf)
+            src.read(band, window=window, out=array)
+            spec = {'name': self.shm.name, 'shape': shape, 'dtype': dtype, 'nodata': src.nodata,
+                    'offset': (int(window.row_off), int(window.col_off)), 'grid_shape': (src.height, src.width),
+                    'transform': tuple(src.transform)[:6], 'crs': src.crs.to_wkt() if src.crs is not None else None}
+        self.owner = True
+        self.init(spec)
+
+    @classmethod
+    def attach(cls, spec: dict):
+        shared = cls.__new__(cls)
+        # pool workers share the resource tracker of the creating process, which unlinks the segment on close
+        shared.shm = shared_memory.SharedMemory(name=spec['name'])
+        shared.owner = False
+        shared.init(spec)
+        return shared
+
+    def init(self, spec: dict):
+        self.spec = spec
+        self.array = np.ndarray(spec['shape'], dtype=spec['dtype'], buffer=self.shm.buf)
+        self.array.flags.writeable = False
+        self.row_off, self.col_off = spec['offset']
+        self.height, self.width = spec['grid_shape']
+        self.count = 1
+        self.dtypes = [spec['dtype']]
+        self.nodata = spec['nodata']
+        self.transform = Affine(*spec['transform'])
+        self.crs = CRS.from_wkt(spec['crs']) if spec['crs'] is not None else None
+        self.block_shapes = [(min(256, max(1, spec['shape'][0])), self.width)]
+
+    def overviews(self, band=1):
+        return []
+
+    def window_transform(self, window):
+        return rasterio.windows.transform(window, self.transform)
+
+    def read(self, band=1, window=None):
+        '''
+        :return: read-only view of the window if it lies inside the shared window, else a copy with the pixels outside
+                 the shared window set to nodata (or 0)
+        '''
+        if window is None:
+            window = rasterio.windows.Window(0, 0, self.width, self.height)
+        (row_start, row_end), (col_start, col_end) = window.toranges()
+        row_start, row_end = int(row_start) - self.row_off, int(row_end) - self.row_off
+        col_start, col_end = int(col_start) - self.col_off, int(col_end) - self.col_off
+        shared_height, shared_width = self.array.shape
+        if row_start >= 0 and col_start >= 0 and row_end <= shared_height and col_end <= shared_width:
+            return self.array[row_start:row_end, col_start:col_end]
+        array = np.full((row_end - row_start, col_end - col_start), self.nodata if self.nodata is not None else 0,
+                        dtype=self.array.dtype)
+        rows = slice(max(row_start, 0), max(min(row_end, shared_height), 0))
+        cols = slice(max(col_start, 0), max(min(col_end, shared_width), 0))
+        array[rows.start - row_start:rows.stop - row_start, cols.start - col_start:cols.stop - col_start] = \
+            self.array[rows, cols]
+        return array
+
+    def close(self):
+        self.array = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def shapefiles_bounds(shape_files: list) -> tuple:
+    ''' :return: (left, bottom, right, top) covering all shape_files '''
+    bounds = []
+    for shape_file in shape_files:
+        with fiona.open(shape_file, "r") as shapefile:
+            bounds.append(shapefile.bounds)
+    bounds = np.array(bounds)
+    return bounds[:, 0].min(), bounds[:, 1].min(), bounds[:, 2].max(), bounds[:, 3].max()
+
+
+@contextlib.contextmanager
+def share_rasters(tif_files: list, shape_files=None):
+    '''
+    Load tif_files, cropped to the union bbox of shape_files, into shared memory for the workers of a pool; the
+    segments are released when leaving the with block.
+
+    > with share_rasters([tif], shps) as shared:
+    >     specs = {tif: raster.spec for tif, raster in shared.items()}  # initargs, attached with SharedRaster.attach
+
+    map_basins does this for a pool of basin workers.
+
+    :return: {tif_file: SharedRaster}
+    '''
+    bounds = shapefiles_bounds(shape_files) if shape_files is not None else None
+    shared = {}
+    try:
+        for tif_file in tif_files:
+            shared[tif_file] = SharedRaster(tif_file, bounds)
+        yield shared
+    finally:
+        for raster in shared.values():
+            raster.close()
+
+
+def attach_rasters(specs: dict) -> dict:
+    ''' :return: {tif_file: SharedRaster} attached in a worker, from the specs of share_rasters '''
+    return {tif_file: SharedRaster.attach(spec) for tif_file, spec in specs.items()}
+
+
+def map_basins(worker, tasks: list, initializer, initargs=(), num_workers=1, tif_files=None, shape_files=None) -> list:
+    '''
+    Run worker on every task, in a pool of num_workers processes or in this process if num_workers is 1. Every
+    process is set up once with initializer(*initargs).
+
+    If tif_files are given, their window covering shape_files is decoded once into shared memory (see share_rasters)
+    and the specs of the segments are passed as the first argument of initializer, to be attached with
+    attach_rasters: workers then map the rasters instead of reading them.
+
+    :return: results of worker, in the order of tasks
+    '''
+    with contextlib.ExitStack() as stack:
+        if tif_files is not None:
+            shared = stack.enter_context(share_rasters(tif_files, shape_files))
+            initargs = ({tif_file: raster.spec for tif_file, raster in shared.items()},) + tuple(initargs)
+        if num_workers > 1:
+            pool = stack.enter_context(Pool(num_workers, initializer=initializer, initargs=initargs))
+            return list(tqdm(pool.imap(worker, tasks), total=len(tasks)))
+        initializer(*initargs)
+        return [worker(task) for task in tqdm(tasks)]
+
+
+class ZonalEngine():
+    '''
+    Zonal statistics of many basins over many rasters.
+
+    Raster handles are kept open, basin geometries and their bboxes are parsed once, and only the window covering
+    each basin is read. Basin masks come from a MaskCache, so rasters sharing a grid rasterize each basin only once
+    (and never again across runs if the cache has a cache_dir). Basins whose window is larger than
+    max_window_pixels are streamed block by block instead (see stats_blocks), so memory stays capped. If
+    pixel_budget is given, stats and stats_stack read every basin at the finest overview level (see build_overviews)
+    whose window fits in the budget, so small basins keep the full resolution and large basins read a decimated
+    level; the decimation factor used is returned with the statistics. Rasters in shared_rasters ({tif_file:
+    SharedRaster}, e.g. from attach_rasters in the worker of a pool) are read from shared memory instead of the tif.
+    Use as a context manager (or call close) to release the handles.
+    '''
+
+    def __init__(self, mask_cache: MaskCache = None, max_window_pixels=2 ** 26, pixel_budget=None,
+                 shared_rasters=None):
+        self.rasters = {}
+        self.basins = {}
+        self.mask_cache = mask_cache if mask_cache is not None else MaskCache()
+        self.max_window_pixels = max_window_pixels
+        self.pixel_budget = pixel_budget
+        self.shared_rasters = shared_rasters if shared_rasters is not None else {}
+
+    def raster(self, tif_file: str, level=0):
+        ''' :param level: 0 for the full resolution, i for the i-th overview of the raster '''
+        if level == 0 and tif_file in self.shared_rasters:
+            return self.shared_rasters[tif_file]
+        if (tif_file, level) not in self.rasters:
+            if level == 0:
+                self.rasters[(tif_file, level)] = rasterio.open(tif_file)
+            else:
+                self.rasters[(tif_file, level)] = rasterio.open(tif_file, overview_level=level - 1)
+        return self.rasters[(tif_file, level)]
+
+    def basin(self, shape_file: str) -> dict:
+        ''' :return: {'shapes': geometries, 'bounds': (left, bottom, right, top), 'hash': geometry hash} '''
+        if shape_file not in self.basins:
+            with fiona.open(shape_file, "r") as shapefile:
+                shapes = [feature["geometry"] for feature in shapefile]
+                self.basins[shape_file] = {'shapes': shapes, 'bounds': shapefile.bounds,
+                                           'hash': MaskCache.geometry_hash(shapes)}
+        return self.basins[shape_file]
+
+    def mask(self, tif_file: str, shape_file: str, level=0):
+        ''' :return: (window, flat pixel indices) of the basin on the grid of the raster, see MaskCache.get '''
+        basin = self.basin(shape_file)
+        return self.mask_cache.get(self.raster(tif_file, level), basin['shapes'], basin['bounds'],
+                                   geometry_hash=basin['hash'])
+
+    def values(self, tif_file: str, shape_file: str, band=1, level=0) -> np.array:
+        ''' :return: 1d array of the raster values inside the basin '''
+        src = self.raster(tif_file, level)
+        window, index = self.mask(tif_file, shape_file, level)
+        if window is None:
+            return np.array([], dtype=src.dtypes[band - 1])
+        return src.read(band, window=window).ravel()[index]
+
+    def window_pixels(self, tif_file: str, shape_file: str, level=0) -> int:
+        window = bounds_window(self.raster(tif_file, level), self.basin(shape_file)['bounds'])
+        return window.width * window.height
+
+    def large(self, tif_file: str, shape_file: str, level=0) -> bool:
+        ''' :return: True if the basin window on the raster is larger than max_window_pixels '''
+        return self.max_window_pixels is not None and \
+            self.window_pixels(tif_file, shape_file, level) > self.max_window_pixels
+
+    def level(self, tif_file: str, shape_file: str, band=1):
+        '''
+        Read level of the basin: the finest level whose basin window fits in pixel_budget, or the coarsest overview
+        if none does. Always 0 (full resolution) without pixel_budget.
+
+        :return: (level, decimation factor)
+        '''
+        if self.pixel_budget is None:
+            return 0, 1
+        pixels = self.window_pixels(tif_file, shape_file)
+        factors = [1] + self.raster(tif_file).overviews(band)
+        for level, factor in enumerate(factors):
+            if pixels / factor ** 2 <= self.pixel_budget:
+                return level, factor
+        return len(factors) - 1, factors[-1]
+
+    def stats(self, tif_file: str, shape_file: str, valid_min=None, valid_max=None, band=1) -> dict:
+        '''
+        :return: count, mean, min, max and std of the valid values (exclusive bounds) inside the basin, and the
+                 decimation factor of the level read (1 for the full resolution)
+        '''
+        level, factor = self.level(tif_file, shape_file, band)
+        if self.large(tif_file, shape_file, level):
+            res = self.stats_blocks(tif_file, shape_file, valid_min, valid_max, band=band, level=level)
+        else:
+            res = summary_stats(valid_values(self.values(tif_file, shape_file, band=band, level=level),
+                                             valid_min, valid_max))
+        res['decimation'] = factor
+        return res
+
+    def stats_stack(self, tif_files: list, shape_file: str, valid_ranges=None, band=1) -> dict:
+        '''
+        Zonal statistics of a stack of rasters for one basin. Rasters are grouped by grid; for every group the basin
+        mask is looked up once and one window is read per raster.
+
+        :param valid_ranges: list of (valid_min, valid_max) aligned with tif_files, None for no limits
+        :return: {tif_file: stats dict (see stats)}
+        '''
+        if valid_ranges is None:
+            valid_ranges = [(None, None)] * len(tif_files)
+        groups = {}
+        for tif_file, valid_range in zip(tif_files, valid_ranges):
+            level, factor = self.level(tif_file, shape_file, band)
+            groups.setdefault(MaskCache.grid_key(self.raster(tif_file, level)), []).append(
+                (tif_file, valid_range, level, factor))
+        res = {}
+        for group in groups.values():
+            tif_file, _, level, _ = group[0]
+            if self.large(tif_file, shape_file, level):
+                for tif_file, (valid_min, valid_max), level, factor in group:
+                    res[tif_file] = self.stats_blocks(tif_file, shape_file, valid_min, valid_max, band=band,
+                                                      level=level)
+                    res[tif_file]['decimation'] = factor
+                continue
+            window, index = self.mask(tif_file, shape_file, level)
+            for tif_file, (valid_min, valid_max), level, factor in group:
+                if window is None:
+                    values = np.array([])
+                else:
+                    values = self.raster(tif_file, level).read(band, window=window).ravel()[index]
+                res[tif_file] = summary_stats(valid_values(values, valid_min, valid_max))
+                res[tif_file]['decimation'] = factor
+        return res
+
+    def stats_blocks(self, tif_file: str, shape_file: str, valid_min=None, valid_max=None, classes=None, band=1,
+                     block_rows=256, level=0) -> dict:
+        '''
+        Block-streaming zonal statistics: the basin bbox is walked in the native blocks of the raster (grouped to at
+        least block_rows rows for striped files), blocks the basin does not touch are skipped, blocks inside the
+        basin are taken whole and only blocks on the boundary are rasterized. Memory is bounded by the block size
+        whatever the size of the basin, and no mask is cached.
+
+        :param classes: number of classes, if given the class histogram is returned (see ZonalAccumulator)
+        :return: stats dict (see stats) or {'counts': np.array}
+        '''
+        src = self.raster(tif_file, level)
+        basin = self.basin(shape_file)
+        accumulator = ZonalAccumulator(valid_min, valid_max, classes)
+        window = bounds_window(src, basin['bounds'])
+        full = rasterio.windows.Window(0, 0, src.width, src.height)
+        if not rasterio.windows.intersect(window, full):
+            return accumulator.result()
+        window = window.intersection(full)
+        geometry = shapely.prepared.prep(shapely.ops.unary_union([shapely.geometry.shape(g) for g in basin['shapes']]))
+        block_height, block_width = src.block_shapes[band - 1]
+        step_rows = block_height * max(1, block_rows // block_height)
+        row_start, row_end = int(window.row_off), int(window.row_off + window.height)
+        col_start, col_end = int(window.col_off), int(window.col_off + window.width)
+        for r0 in range(row_start // step_rows * step_rows, row_end, step_rows):
+            for c0 in range(col_start // block_width * block_width, col_end, block_width):
+                r, c = max(r0, row_start), max(c0, col_start)
+                block = rasterio.windows.Window(c, r, min(c0 + block_width, col_end) - c,
+                                                min(r0 + step_rows, row_end) - r)
+                box = shapely.geometry.box(*rasterio.windows.bounds(block, src.transform))
+                if not geometry.intersects(box):
+                    continue
+                values = src.read(band, window=block)
+                if not geometry.contains(box):
+                    values = values[rasterio.features.geometry_mask(basin['shapes'], out_shape=values.shape,
+                                                                    transform=src.window_transform(block),
+                                                                    invert=True)]
+                accumulator.update(values.ravel())
+        return accumulator.result()
+
+    def membership(self, tif_file: str, shape_files: list):
+        '''
+        Sparse basin x pixel membership on the grid of the raster, in CSR layout: basin i owns the sorted flat pixel
+        indices (of the whole raster) indices[indptr[i]:indptr[i + 1]]. Overlapping and nested basins share pixels.
+
+        :return: (indptr, indices)
+        '''
+        src = self.raster(tif_file)
+        indptr = [0]
+        indices = []
+        for shape_file in shape_files:
+            window, index = self.mask(tif_file, shape_file)
+            if window is not None:
+                rows = int(window.row_off) + index // int(window.width)
+                cols = int(window.col_off) + index % int(window.width)
+                indices.append(rows * src.width + cols)
+            indptr.append(indptr[-1] + (len(indices[-1]) if window is not None else 0))
+        indices = np.concatenate(indices) if len(indices) > 0 else np.array([], dtype=np.int64)
+        return np.array(indptr), indices.astype(np.int64)
+
+    def stats_raster_major(self, tif_file: str, shape_files: list, valid_min=None, valid_max=None, classes=None,
+                           block_rows=512, band=1) -> dict:
+        '''
+        Raster-major zonal statistics: the raster is streamed once, strip by strip, and the statistics of all basins
+        are accumulated at the same time, so I/O is O(raster size) instead of O(sum of basin areas).
+
+        :param classes: number of classes, if given the class histogram (counts of values 0..classes - 1) of every
+                        basin is returned instead of count/mean/min/max/std
+        :return: {shape_file: stats dict (see stats) or {'counts': np.array}}
+        '''
+        src = self.raster(tif_file)
+        indptr, indices = self.membership(tif_file, shape_files)
+        n = len(shape_files)
+        accumulators = [ZonalAccumulator(valid_min, valid_max, classes) for _ in range(n)]
+
+        if len(indices) > 0:
+            rows = indices // src.width
+            cols = indices % src.width
+            col_start, col_end = cols.min(), cols.max() + 1
+            basin_rows = [(rows[indptr[i]], rows[indptr[i + 1] - 1]) if indptr[i + 1] > indptr[i] else (-1, -1)
+                          for i in range(n)]
+            block_height = src.block_shapes[band - 1][0]
+            block_rows = math.ceil(block_rows / block_height) * block_height
+            row_start = rows.min() // block_height * block_height
+            for r0 in range(row_start, rows.max() + 1, block_rows):
+                r1 = min(r0 + block_rows, src.height)
+                window = rasterio.windows.Window(col_start, r0, col_end - col_start, r1 - r0)
+                strip = src.read(band, window=window).ravel()
+                for i in range(n):
+                    if basin_rows[i][1] < r0 or basin_rows[i][0] >= r1:
+                        continue
+                    basin = indices[indptr[i]:indptr[i + 1]]
+                    basin = basin[np.searchsorted(basin, r0 * src.width):np.searchsorted(basin, r1 * src.width)]
+                    values = strip[(basin // src.width - r0) * window.width + (basin % src.width - col_start)]
+                    accumulators[i].update(values)
+        return {shape_file: accumulator.result() for shape_file, accumulator in zip(shape_files, accumulators)}
+
+    def close(self):
+        for src in self.rasters.values():
+            src.close()
+        self.rasters = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()